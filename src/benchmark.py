@@ -0,0 +1,272 @@
+import argparse
+import io
+import json
+import random
+import tracemalloc
+from contextlib import redirect_stdout
+from timeit import default_timer as time
+
+import cheating
+import craft_planner
+
+# Benchmarks the planners in cheating.py and craft_planner.py on the recipe files in this
+# folder and on generated crafting domains of increasing size.
+# For every (domain, goal, planner) run it records the wall time, the number of nodes
+# expanded (calls to the graph functions) and generated (the nodes they returned), the
+# peak memory traced while planning, and the cost of the plan found.
+#
+#   python benchmark.py
+#   python benchmark.py --depth 2 3 4 --branching 2 3 --quantity 1 4 --limit 10 --json bench.json
+
+# The goals run on the hand written recipe files.
+FIXED_GOALS = [
+    ('crafting.json', {'furnace': 1}),
+    ('crafting.json', {'stone_pickaxe': 1}),
+    ('crafting.json', {'iron_pickaxe': 1}),
+    ('crafting.json', {'cart': 1}),
+    ('crafting.json', {'rail': 20}),
+    ('craftingSimplified.json', {'bench': 2, 'stick': 4}),
+    ('craftingSimplified.json', {'furnace': 1}),
+]
+
+
+#############################################################################
+################ SYNTHETIC DOMAIN RELATED FUNCTIONS #########################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# A generated tech tree in the same json format as crafting.json.
+# Layer 0 holds branching raw items that are gathered from nothing. Every item of a
+# deeper layer is crafted from branching items of the layers below it, in amounts of 1
+# to quantity, and makes 1 to quantity of itself per craft. Every other layer gets a
+# tool: an item that later recipes require but never consume, like a bench or a pickaxe.
+# The goal is one of the items of the top layer.
+def make_domain(depth, branching, quantity, seed = 0):
+    rng = random.Random(seed)
+    recipes = {}
+    layers = [['raw_{}'.format(k) for k in range(branching)]]
+    tools = []
+
+    for item in layers[0]:
+        recipes['gather {}'.format(item)] = {'Produces': {item: 1}, 'Time': rng.randint(1, 4)}
+
+    for level in range(1, depth + 1):
+        below = [item for layer in layers for item in layer]
+        layer = ['item_{}_{}'.format(level, k) for k in range(branching)]
+        for item in layer:
+            inputs = rng.sample(below, min(branching, len(below)))
+            rule = {
+                'Produces': {item: rng.randint(1, quantity)},
+                'Consumes': {needed: rng.randint(1, quantity) for needed in inputs},
+                'Time': rng.randint(1, 3),
+            }
+            if tools:
+                rule['Requires'] = {rng.choice(tools): True}
+            recipes['craft {}'.format(item)] = rule
+        layers.append(layer)
+
+        if level % 2 == 1:
+            tool = 'tool_{}'.format(level)
+            recipes['craft {}'.format(tool)] = {
+                'Produces': {tool: 1},
+                'Consumes': {rng.choice(layer): 1},
+                'Time': 1,
+            }
+            tools.append(tool)
+
+    items = sorted({item for layer in layers for item in layer} | set(tools))
+    return {
+        'Items': items,
+        'Initial': {},
+        'Goal': {layers[-1][0]: 1},
+        'Recipes': recipes,
+    }
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+############ END OF SYNTHETIC DOMAIN RELATED FUNCTIONS ######################
+#############################################################################
+
+
+#############################################################################
+################ PLANNER RELATED FUNCTIONS ##################################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# Wraps a graph function so every call counts as an expansion and every node it returns
+# as a generated node.
+def counting(graph_function, counts):
+    def counted(*args, **kwargs):
+        counts['expanded'] += 1
+        children = list(graph_function(*args, **kwargs))
+        counts['generated'] += len(children)
+        return children
+    return counted
+
+# Each planner takes (crafting json, goal, limit, counts) and returns the plan cost, or
+# None when it found no plan. They all plan from the json's initial inventory.
+
+def cheating_search(heuristic, dominance = False, caps = None, reduction = False, algorithm = 'astar'):
+    def run(Crafting, goal, limit, counts):
+        cheating.load_recipes(Crafting)
+        state = cheating.State(Crafting['Initial'])
+        graph = counting(cheating.graph, counts)
+        path = cheating.search(graph, state, cheating.make_goal_checker(goal), limit, heuristic, goal,
+                               dominance = dominance, caps = caps, reduction = reduction, algorithm = algorithm)
+        return cheating.path_cost(path) if path is not None else None
+    return run
+
+def cheating_bi_search(Crafting, goal, limit, counts):
+    cheating.load_recipes(Crafting)
+    state = cheating.State(Crafting['Initial'])
+    graph = counting(cheating.graph, counts)
+    backwards_graph = cheating.backwards_graph
+    cheating.backwards_graph = counting(backwards_graph, counts)
+    try:
+        path = cheating.bi_search(graph, state, cheating.make_goal_checker(goal), limit, cheating.heuristic, goal)
+    finally:
+        cheating.backwards_graph = backwards_graph
+    return cheating.path_cost(path) if path is not None else None
+
+def cheating_regression_search(Crafting, goal, limit, counts):
+    cheating.load_recipes(Crafting)
+    state = cheating.State(Crafting['Initial'])
+    backwards_graph = cheating.backwards_graph
+    cheating.backwards_graph = counting(backwards_graph, counts)
+    try:
+        path = cheating.regression_search(state, goal, limit)
+    finally:
+        cheating.backwards_graph = backwards_graph
+    return cheating.path_cost(path) if path is not None else None
+
+def cheating_search_relevant(Crafting, goal, limit, counts):
+    graph = cheating.graph
+    cheating.graph = counting(graph, counts)
+    try:
+        path = cheating.search_relevant(Crafting, limit, 'h_max', goal = goal, caps = True, reduction = True)
+    finally:
+        cheating.graph = graph
+    return cheating.path_cost(path) if path is not None else None
+
+# relaxed_search() solves the delete relaxation, so its "cost" is the relaxed plan's
+# length plus Time that relaxation_heuristic() used to be made of.
+def cheating_relaxed_search(Crafting, goal, limit, counts):
+    cheating.load_recipes(Crafting)
+    state = cheating.State(Crafting['Initial'])
+    relaxed_graph = cheating.relaxed_graph
+    cheating.relaxed_graph = counting(relaxed_graph, counts)
+    try:
+        result = cheating.relaxed_search(None, state, cheating.make_goal_checker(goal), limit)
+    finally:
+        cheating.relaxed_graph = relaxed_graph
+    return -result if result else None
+
+def craft_planner_search(Crafting, goal, limit, counts):
+    craft_planner.State.set_layout(Crafting['Items'])
+    craft_planner.all_recipes = []
+    costs = {}
+    for name, rule in Crafting['Recipes'].items():
+        checker = craft_planner.make_checker(rule)
+        effector = craft_planner.make_effector(rule)
+        craft_planner.all_recipes.append(craft_planner.Recipe(name, checker, effector, rule['Time']))
+        costs[name] = rule['Time']
+    state = craft_planner.State(Crafting['Initial'])
+    graph = counting(craft_planner.graph, counts)
+    path = craft_planner.search(graph, state, craft_planner.make_goal_checker(goal), limit, craft_planner.heuristic)
+    if path is None:
+        return None
+    return sum(costs[action] for state, action in path if action in costs)
+
+PLANNERS = {
+    'search': cheating_search(cheating.heuristic),
+    'search h_max': cheating_search('h_max'),
+    'search h_add': cheating_search('h_add'),
+    'search ff': cheating_search('ff'),
+    'search h_max dominance': cheating_search('h_max', dominance = True),
+    'search h_max caps': cheating_search('h_max', caps = True),
+    'search h_max caps reduction': cheating_search('h_max', caps = True, reduction = True),
+    'search h_max caps relevant': cheating_search_relevant,
+    'search ida': cheating_search('h_max', caps = True, reduction = True, algorithm = 'ida'),
+    'search sma': cheating_search('h_max', caps = True, reduction = True, algorithm = 'sma'),
+    'regression_search': cheating_regression_search,
+    'bom_search': cheating_search(cheating.heuristic, algorithm = 'bom'),
+    'bi_search': cheating_bi_search,
+    'relaxed_search': cheating_relaxed_search,
+    'craft_planner.search': craft_planner_search,
+}
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+################# END OF PLANNER RELATED FUNCTIONS ##########################
+#############################################################################
+
+
+# Runs one planner on one goal. The time comes from a run without memory tracing, which
+# slows everything down; the peak memory, when asked for, from a second traced run.
+def run_benchmark(planner, Crafting, goal, limit, measure_memory = True):
+    counts = {'expanded': 0, 'generated': 0}
+    with redirect_stdout(io.StringIO()):
+        start_time = time()
+        cost = PLANNERS[planner](Crafting, goal, limit, counts)
+        wall_time = time() - start_time
+
+        peak_memory = None
+        if measure_memory:
+            tracemalloc.start()
+            PLANNERS[planner](Crafting, goal, limit, {'expanded': 0, 'generated': 0})
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return {
+        'planner': planner,
+        'goal': goal,
+        'time': wall_time,
+        'expanded': counts['expanded'],
+        'generated': counts['generated'],
+        'peak_memory': peak_memory,
+        'cost': cost,
+    }
+
+def print_row(domain, result):
+    memory = '{:.1f}'.format(result['peak_memory'] / 1024 / 1024) if result['peak_memory'] is not None else '-'
+    print('{:<28} {:<24} {:<22} {:>8.3f} {:>9} {:>10} {:>8} {:>6}'.format(
+        domain, json.dumps(result['goal'], sort_keys=True)[:24], result['planner'], result['time'],
+        result['expanded'], result['generated'], memory,
+        result['cost'] if result['cost'] is not None else '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the crafting planners.')
+    parser.add_argument('--limit', type=float, default=10, help='time limit per run, in seconds')
+    parser.add_argument('--planners', nargs='+', default=list(PLANNERS), choices=list(PLANNERS))
+    parser.add_argument('--depth', type=int, nargs='+', default=[2, 3, 4], help='synthetic tree depths')
+    parser.add_argument('--branching', type=int, nargs='+', default=[2, 3], help='synthetic items per layer and inputs per recipe')
+    parser.add_argument('--quantity', type=int, nargs='+', default=[1, 3], help='synthetic largest amount per recipe')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-fixed', action='store_true', help='skip the goals on the recipe files')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run for peak memory')
+    parser.add_argument('--json', help='also write every result to this file')
+    args = parser.parse_args()
+
+    runs = []
+    if not args.no_fixed:
+        for file_name, goal in FIXED_GOALS:
+            with open(file_name) as f:
+                Crafting = json.load(f)
+            runs.append((file_name, Crafting, goal))
+    for depth in args.depth:
+        for branching in args.branching:
+            for quantity in args.quantity:
+                Crafting = make_domain(depth, branching, quantity, args.seed)
+                runs.append(('d{} b{} q{} ({} recipes)'.format(depth, branching, quantity, len(Crafting['Recipes'])),
+                             Crafting, Crafting['Goal']))
+
+    print('{:<28} {:<24} {:<22} {:>8} {:>9} {:>10} {:>8} {:>6}'.format(
+        'domain', 'goal', 'planner', 'time (s)', 'expanded', 'generated', 'mem (MB)', 'cost'))
+    results = []
+    for domain, Crafting, goal in runs:
+        for planner in args.planners:
+            result = run_benchmark(planner, Crafting, goal, args.limit, not args.no_memory)
+            result['domain'] = domain
+            results.append(result)
+            print_row(domain, result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
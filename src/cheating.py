@@ -1,9 +1,20 @@
 import json
+import logging
+import hashlib
+import marshal
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib.util import MAGIC_NUMBER
+from array import array
 from collections import namedtuple, defaultdict, OrderedDict
 from timeit import default_timer as time
-from _heapq import heappop, heappush
+from _heapq import heappop, heappush, heapify
 from math import inf
 
+# Messages about how searches went. Off unless logging is configured, as __main__ does.
+log = logging.getLogger('cheating')
+
 Recipe = namedtuple('Recipe', ['name', 'check', 'effect', 'relaxed_effect', 'cost'])
 
 REQUIRED_ITEMS = set()
@@ -12,6 +23,8 @@ name_to_produces = {}
 #A wrapper functino over effectors in the CookBookEntry representation
 #Helps with keeping track of what effector is linked to what and creates what etc.
 class EffectorWrapper():
+    __slots__ = ('effector', 'creates', 'required', 'cost')
+
     def __init__(self, effector, name, cost):
         self.effector = effector
         self.creates = name
@@ -25,8 +38,20 @@ class EffectorWrapper():
     def __str__(self):
         return str("This is a {} effector.".format(self.creates))
 
+# An effector that runs a recipe times times in one step; creates is the recipe's name
+# and cost the Time of all the runs together.
+class BatchEffector(EffectorWrapper):
+    __slots__ = ('times',)
+
+    def __init__(self, effector, name, cost, times):
+        super().__init__(effector, name, cost)
+        self.times = times
+
 # Node representation for A* to help readability
+# Searches create one per generated state, so it is kept to four slots.
 class Node():
+    __slots__ = ('name', 'state', 'cost', 'effect')
+
     def __init__(self, name, state, cost, effect = None):
         self.name = name
         self.state = state
@@ -39,6 +64,353 @@ class Node():
     def __str__(self):
         return "ChildNode name:{} and state{}".format(self.name, self.state)
 
+# The A* open list. A binary heap indexed by state, so membership tests are a dictionary
+# lookup and a state can be pushed again with a lower priority (decrease-key). The older,
+# worse heap entry is not searched for and removed; it stays in the heap and pop() skips
+# it because it no longer matches the entry recorded for its state (lazy deletion).
+class OpenList():
+    def __init__(self):
+        self.heap = []
+        # state -> (priority, tie breaker) of its one live entry in the heap
+        self.entries = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, state):
+        return state in self.entries
+
+    # Adds the state, or lowers its priority. Returns False when the state was already
+    # queued with a priority at least as good.
+    def push(self, state, priority, item=None):
+        entry = self.entries.get(state)
+        if entry is not None and entry[0] <= priority:
+            return False
+        self.counter += 1
+        self.entries[state] = (priority, self.counter)
+        heappush(self.heap, (priority, self.counter, state, item))
+        return True
+
+    # Removes and returns (priority, state, item) with the lowest priority.
+    def pop(self):
+        while self.heap:
+            priority, count, state, item = heappop(self.heap)
+            entry = self.entries.get(state)
+            if entry is not None and entry[1] == count:
+                del self.entries[state]
+                return priority, state, item
+        raise IndexError("pop from an empty OpenList")
+
+    # The lowest live priority without removing it, or inf when empty.
+    def peek(self):
+        while self.heap:
+            priority, count, state, item = self.heap[0]
+            entry = self.entries.get(state)
+            if entry is not None and entry[1] == count:
+                return priority
+            heappop(self.heap)
+        return inf
+
+    def discard(self, state):
+        self.entries.pop(state, None)
+
+# What search() remembers about every state it has queued, as parallel arrays indexed by a
+# state id instead of a Node and a few dictionary entries per state. Each state is
+# interned once, in ids and states; parents, actions and costs hold the id of the state it
+# was best reached from (-1 for the start), the id of the action that got there and the
+# cost of getting there, and closed marks the expanded states. Actions are interned by name
+# into actions_taken, as (name, effect) pairs. Paths are rebuilt by following parents.
+class SearchRecords():
+    def __init__(self):
+        self.ids = {}
+        self.states = []
+        self.parents = array('l')
+        self.actions = array('l')
+        self.costs = array('d')
+        self.closed = bytearray()
+        self.action_ids = {}
+        self.actions_taken = []
+
+    def __len__(self):
+        return len(self.states)
+
+    def intern(self, state):
+        state_id = self.ids.get(state)
+        if state_id is None:
+            state_id = len(self.states)
+            self.ids[state] = state_id
+            self.states.append(state)
+            self.parents.append(-1)
+            self.actions.append(-1)
+            self.costs.append(inf)
+            self.closed.append(0)
+        return state_id
+
+    # Records that the state with state_id is reached from parent through node's action,
+    # for cost in total.
+    def record(self, state_id, parent, node, cost):
+        action = self.action_ids.get(node.name)
+        if action is None:
+            action = self.action_ids[node.name] = len(self.actions_taken)
+            self.actions_taken.append((node.name, node.effect))
+        self.parents[state_id] = parent
+        self.actions[state_id] = action
+        self.costs[state_id] = cost
+
+    # Name of the action that last reached the state, or None for the start.
+    def action_name(self, state_id):
+        action = self.actions[state_id]
+        return self.actions_taken[action][0] if action >= 0 else None
+
+    # The path to the state in the [(state, action)] format of reconstruct_path().
+    def path(self, state_id):
+        total_path = []
+        while state_id >= 0:
+            action = self.actions[state_id]
+            total_path.append((self.states[state_id], self.actions_taken[action][1] if action >= 0 else None))
+            state_id = self.parents[state_id]
+        return total_path
+
+# Finds the stored inventories that are covered by (<= on every item) or that cover
+# (>= on every item) a given one. Entries are kept in buckets by their support, the set of
+# items they hold any of: an entry can only cover counts if its support includes theirs,
+# and only be covered by them if its support is part of theirs. For each item there is a
+# bitset of the buckets holding it, so a query finds its candidate buckets with one AND
+# per item and never looks at the others. Inside a bucket every entry gets a slot, a bit
+# position, and for each item and amount there is an integer used as a bitset of the
+# slots whose entry holds at least that amount of the item, so a bucket is searched with
+# one AND per item instead of a comparison against every entry in it.
+class DominanceIndex():
+    def __init__(self, by_support = True):
+        # Without by_support everything goes in one bucket. That is faster when queries come
+        # from inventories that hold many items, which would match most buckets anyway.
+        self.by_support = by_support
+        # Buckets by id and by support mask, and counts -> the bucket holding them.
+        self.buckets = []
+        self.supports = {}
+        self.homes = {}
+        # holding[i]: bitset of the ids of the buckets whose support has item i
+        self.holding = defaultdict(int)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, counts, value):
+        bucket = self.homes.get(counts)
+        if bucket is None:
+            support = 0
+            if self.by_support:
+                for i, count in enumerate(counts):
+                    if count:
+                        support |= 1 << i
+            bucket = self.supports.get(support)
+            if bucket is None:
+                bucket = self.supports[support] = DominanceBucket(support)
+                bit = 1 << len(self.buckets)
+                self.buckets.append(bucket)
+                for i in range(support.bit_length()):
+                    if support >> i & 1:
+                        self.holding[i] |= bit
+            self.homes[counts] = bucket
+        if bucket.add(counts, value):
+            self.size += 1
+
+    def discard(self, counts):
+        bucket = self.homes.get(counts)
+        if bucket is not None and bucket.discard(counts):
+            self.size -= 1
+
+    # The buckets whose bits are set in ids.
+    def pick(self, ids):
+        buckets = self.buckets
+        while ids:
+            low = ids & -ids
+            yield buckets[low.bit_length() - 1]
+            ids ^= low
+
+    # Values of the entries that are <= counts on every item.
+    def covered_by(self, counts):
+        if not self.by_support:
+            for bucket in self.buckets:
+                yield from bucket.covered_by(counts)
+            return
+        ids = (1 << len(self.buckets)) - 1
+        for i, holding in self.holding.items():
+            if not counts[i]:
+                ids &= ~holding
+        for bucket in self.pick(ids):
+            yield from bucket.covered_by(counts)
+
+    # Values of the entries that are >= counts on every item.
+    def covering(self, counts):
+        if not self.by_support:
+            for bucket in self.buckets:
+                yield from bucket.covering(counts)
+            return
+        ids = (1 << len(self.buckets)) - 1
+        holding = self.holding
+        for i, count in enumerate(counts):
+            if count:
+                ids &= holding.get(i, 0)
+                if not ids:
+                    return
+        for bucket in self.pick(ids):
+            yield from bucket.covering(counts)
+
+# The entries of one DominanceIndex bucket, all holding the same items.
+class DominanceBucket():
+    def __init__(self, support):
+        self.support = support
+        # slot -> (counts, value), None once discarded, and counts -> slot
+        self.entries = []
+        self.slots = {}
+        # item -> [bitset of the slots holding at least amount + 1 of it]
+        self.at_least = {}
+        # Slots still in use; discarded ones are cleared here and rebuilt away once they
+        # are half the bucket.
+        self.live = 0
+        self.size = 0
+
+    # True when counts were not in the bucket yet.
+    def add(self, counts, value):
+        slot = self.slots.get(counts)
+        if slot is not None:
+            fresh = self.entries[slot] is None
+            self.entries[slot] = (counts, value)
+            if fresh:
+                self.live |= 1 << slot
+                self.size += 1
+            return fresh
+        slot = len(self.entries)
+        self.entries.append((counts, value))
+        self.slots[counts] = slot
+        bit = 1 << slot
+        for i, count in enumerate(counts):
+            if not count:
+                continue
+            levels = self.at_least.get(i)
+            if levels is None:
+                levels = self.at_least[i] = []
+            while len(levels) < count:
+                levels.append(0)
+            for amount in range(count):
+                levels[amount] |= bit
+        self.live |= bit
+        self.size += 1
+        return True
+
+    # True when counts were in the bucket.
+    def discard(self, counts):
+        slot = self.slots.get(counts)
+        if slot is None or self.entries[slot] is None:
+            return False
+        self.entries[slot] = None
+        self.live &= ~(1 << slot)
+        self.size -= 1
+        if self.size and self.size * 2 < len(self.entries):
+            self.compact()
+        return True
+
+    def compact(self):
+        entries = [entry for entry in self.entries if entry is not None]
+        self.entries = []
+        self.slots = {}
+        self.at_least = {}
+        self.live = 0
+        self.size = 0
+        for counts, value in entries:
+            self.add(counts, value)
+
+    def values(self, slots):
+        entries = self.entries
+        while slots:
+            low = slots & -slots
+            yield entries[low.bit_length() - 1][1]
+            slots ^= low
+
+    def covered_by(self, counts):
+        slots = self.live
+        for i, levels in self.at_least.items():
+            if counts[i] < len(levels):
+                slots &= ~levels[counts[i]]
+        return self.values(slots)
+
+    def covering(self, counts):
+        slots = self.live
+        at_least = self.at_least
+        for i, count in enumerate(counts):
+            if count:
+                levels = at_least.get(i)
+                if levels is None or count > len(levels):
+                    return self.values(0)
+                slots &= levels[count - 1]
+                if not slots:
+                    break
+        return self.values(slots)
+
+# What happened during one search, and optional callbacks into it.
+# Pass a SearchStats to search() or bi_search() as stats= and it is filled in as the search
+# runs; afterwards it also holds the cost and length of the path that was returned. Every
+# callback is optional: on_expand(state, queue_size) for each expanded state,
+# on_solution(path) when a path is found. Searches given no stats object skip all of this.
+# queue_sizes samples (nodes expanded so far, open list size) every sample_every expansions.
+class SearchStats():
+    def __init__(self, on_expand = None, on_solution = None, sample_every = 100):
+        self.on_expand = on_expand
+        self.on_solution = on_solution
+        self.sample_every = sample_every
+
+        self.expanded = 0
+        self.generated = 0
+        self.duplicates = 0
+        self.heuristic_calls = 0
+        self.heuristic_time = 0.0
+        self.queue_sizes = []
+        self.start_time = None
+        self.time_to_solution = None
+        self.total_time = None
+        self.cost = None
+        self.length = None
+
+    def start(self):
+        self.start_time = time()
+
+    # Wraps a heuristic so its calls are counted and timed.
+    def timed(self, heuristic):
+        def timed_heuristic(*args):
+            self.heuristic_calls += 1
+            start_time = time()
+            value = heuristic(*args)
+            self.heuristic_time += time() - start_time
+            return value
+        return timed_heuristic
+
+    def expand(self, state, queue_size):
+        self.expanded += 1
+        if self.expanded % self.sample_every == 0:
+            self.queue_sizes.append((self.expanded, queue_size))
+        if self.on_expand is not None:
+            self.on_expand(state, queue_size)
+
+    def solution(self, path):
+        if self.time_to_solution is None:
+            self.time_to_solution = time() - self.start_time
+        self.cost = path_cost(path)
+        self.length = len(path) - 1
+        if self.on_solution is not None:
+            self.on_solution(path)
+
+    def finish(self):
+        self.total_time = time() - self.start_time
+
+    def __str__(self):
+        return ("expanded {}, generated {}, duplicates {}, heuristic calls {} ({:.3f} s), "
+                "first solution after {} s, total {:.3f} s, cost {}".format(
+                    self.expanded, self.generated, self.duplicates, self.heuristic_calls,
+                    self.heuristic_time, self.time_to_solution, self.total_time or 0, self.cost))
+
 # A datastructure that keeps hold of lots of information regarding cookbook entries
 class CookBookEntry():
 
@@ -58,6 +430,11 @@ class CookBookEntry():
         self.actively_learned = False
         self.catalyst = None
 
+        # Learned sub-plans for the product, keyed by (amount, the starting inventory
+        # projected onto the items that can matter for making it), see learn_from_search.
+        self.macros = {}
+        self.relevant = None
+
     #Hash on the name
     def __hash__(self):
         return hash(self.name)
@@ -67,9 +444,11 @@ class CookBookEntry():
             self.name, self.requires, self.consumes, self.produces, self.cost, self.effector, self.ProductName, self.path))
 
     #Updates the product name based on what is produced.
+    # A recipe that produces nothing keeps None.
     def updateProductName(self):
-        self.ProductName = list(self.produces.keys())[0]
-        self.effector.creates = self.ProductName
+        if self.produces:
+            self.ProductName = list(self.produces.keys())[0]
+            self.effector.creates = self.ProductName
 
     #Updates the path by taking in the path that is necesary to get to state where
     # you can add its own effector and get to the result
@@ -78,29 +457,115 @@ class CookBookEntry():
             self.path += path_needed_to_get_here
         self.path.append(self.effector)
 
-class State(OrderedDict):
-    """ This class is a thin wrapper around an OrderedDict, which is simply a dictionary which keeps the order in
-        which elements are added (for consistent key-value pair comparisons). Here, we have provided functionality
-        for hashing, should you need to use a state as a key in another dictionary, e.g. distance[state] = 5. By
-        default, dictionaries are not hashable. Additionally, when the state is converted to a string, it removes
-        all items with quantity 0.
+# A learned sub-plan: the recipes that make amount of product, with their total Time,
+# the least inventory they can run from (need) and their net effect on it (delta). need
+# and delta are counts in the State layout, so checking and applying a whole macro
+# costs as much as a single recipe.
+class Macro():
+    def __init__(self, product, amount, steps, cost, need, delta):
+        self.product = product
+        self.amount = amount
+        self.steps = steps
+        self.cost = cost
+        self.need = need
+        self.delta = delta
+
+    def applies(self, state):
+        for have, need in zip(state.counts, self.need):
+            if have < need:
+                return False
+        return True
+
+    def apply(self, state):
+        return State.from_counts([have + change for have, change in zip(state.counts, self.delta)])
 
-        Use of this state representation is optional, should you prefer another.
+    def __str__(self):
+        return "Macro for {} {} costing {}: {}".format(self.amount, self.product, self.cost, self.steps)
+
+class State():
+    """ This class is a compact inventory whose counts never change. All states share one fixed item layout, which is set once from
+        Crafting['Items'] with State.set_layout(), and each state only holds a tuple of counts in that order. The hash
+        is computed once when the state is built, so using a state as a key in another dictionary, e.g.
+        distance[state] = 5, or putting it in a set costs no more than an integer comparison. Reading still works like
+        the old dictionary version (state['plank'], state.items(), ...). Additionally, when the state is converted to
+        a string, it removes all items with quantity 0.
+
+        The counts, and with them the hash and equality, are never changed in place. Effectors build the next state
+        from a list of counts with State.from_counts(). The one field that does change is made, a hint for
+        RecipeBook.successors() that it sets on the states it makes and clears on the state it expands; it is never
+        part of what a state is, so states that differ only in it are the same state.
     """
 
-    def __key(self):
-        return tuple(self.items())
+    # made is (bitmask of the recipe ids applicable to the parent, id of the recipe run on it)
+    # for states made by RecipeBook.successors(), and None for the rest.
+    __slots__ = ('counts', '_hash', 'made')
+
+    # The shared item layout: item names in order, and item name -> position in counts.
+    ITEMS = ()
+    INDEX = {}
+
+    @classmethod
+    def set_layout(cls, items):
+        cls.ITEMS = tuple(items)
+        cls.INDEX = {item: i for i, item in enumerate(cls.ITEMS)}
+
+    @classmethod
+    def from_counts(cls, counts):
+        new_state = cls.__new__(cls)
+        new_state.counts = tuple(counts)
+        new_state._hash = hash(new_state.counts)
+        new_state.made = None
+        return new_state
+
+    def __init__(self, inventory=None):
+        counts = [0] * len(self.ITEMS)
+        if inventory:
+            for item, amount in inventory.items():
+                counts[self.INDEX[item]] = amount
+        self.counts = tuple(counts)
+        self._hash = hash(self.counts)
+        self.made = None
+
+    def __getitem__(self, item):
+        return self.counts[self.INDEX[item]]
+
+    def get(self, item, default=0):
+        if item in self.INDEX:
+            return self.counts[self.INDEX[item]]
+        return default
+
+    def __contains__(self, item):
+        return item in self.INDEX
+
+    def __iter__(self):
+        return iter(self.ITEMS)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def keys(self):
+        return self.ITEMS
+
+    def values(self):
+        return self.counts
+
+    def items(self):
+        return zip(self.ITEMS, self.counts)
 
     def __hash__(self):
-        return hash(self.__key())
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, State):
+            return NotImplemented
+        return self._hash == other._hash and self.counts == other.counts
 
     def __lt__(self, other):
-        return self.__key() < other.__key()
+        return self.counts < other.counts
 
     def copy(self):
-        new_state = State()
-        new_state.update(self)
-        return new_state
+        # Immutable, so sharing is safe.
+        return self
 
     def __str__(self):
         return str(dict(item for item in self.items() if item[1] > 0))
@@ -109,6 +574,332 @@ class State(OrderedDict):
 #Creates the item from a given path
 # Final implementatino doesnt use this.
 
+#############################################################################
+############ RECIPE COMPILATION RELATED FUNCTIONS ###########################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# The whole recipe set compiled once into rows of numbers over the State layout.
+# consume, require, produce and delta are matrices with one row per recipe and one
+# column per item, in the same order as Crafting['Recipes'] (and so as all_recipes).
+# need, changes and gains are the sparse versions of those rows that the hot loop
+# walks: need[r] is [(column, amount)] that has to be held to run recipe r, changes[r]
+# is [(column, change)] that running it adds to the state, and gains[r] is the same
+# for its products only.
+# With 17 items and at most three non zero entries per row, walking the sparse rows
+# is several times faster than comparing or adding all 17 columns.
+class RecipeBook():
+
+    def __init__(self, items, recipes):
+        self.items = tuple(items)
+        self.index = {item: i for i, item in enumerate(self.items)}
+        width = len(self.items)
+
+        self.names = []
+        self.ids = {}
+        self.costs = []
+        self.consume = []
+        self.require = []
+        self.produce = []
+        self.delta = []
+        self.need = []
+        self.changes = []
+        self.gains = []
+
+        for name, rule in recipes.items():
+            consume = [0] * width
+            require = [0] * width
+            produce = [0] * width
+            for item, amount in rule.get("Consumes", {}).items():
+                consume[self.index[item]] = amount
+            # Requires only ever says "have at least one", whatever the json value is.
+            for item in rule.get("Requires", {}):
+                require[self.index[item]] = 1
+            for item, amount in rule.get("Produces", {}).items():
+                produce[self.index[item]] = amount
+            delta = [p - c for p, c in zip(produce, consume)]
+
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.costs.append(rule["Time"])
+            self.consume.append(tuple(consume))
+            self.require.append(tuple(require))
+            self.produce.append(tuple(produce))
+            self.delta.append(tuple(delta))
+            self.need.append(tuple((i, max(c, q)) for i, (c, q) in enumerate(zip(consume, require)) if c or q))
+            self.changes.append(tuple((i, d) for i, d in enumerate(delta) if d))
+            self.gains.append(tuple((i, p) for i, p in enumerate(produce) if p))
+
+        # needed_by[i] is a bitmask of the recipes that consume or require item i. Running
+        # recipe r can only make applicable the recipes in gained_by[r], that need something
+        # r adds, and only stop the ones in lost_by[r], that need something r takes away, so
+        # the applicable recipes of a successor are worked out from its parent's by checking
+        # just those (see successors()).
+        self.needed_by = [0] * width
+        for r, need in enumerate(self.need):
+            for i, amount in need:
+                self.needed_by[i] |= 1 << r
+        self.gained_by = []
+        self.lost_by = []
+        for r, changes in enumerate(self.changes):
+            gained = 0
+            lost = 0
+            for i, change in changes:
+                if change > 0:
+                    gained |= self.needed_by[i]
+                else:
+                    lost |= self.needed_by[i]
+            self.gained_by.append(gained)
+            self.lost_by.append(lost)
+
+        # Recipes that commute: running them in either order is possible from the same
+        # inventories and ends in the same one. That holds when neither makes anything the
+        # other needs, neither consumes anything the other only requires, and they make
+        # different items (so neither can put the other past its item_caps()).
+        # commutes[a] is a bitmask of the recipes before a that commute with it.
+        self.commutes = []
+        for a in range(len(self.names)):
+            mask = 0
+            for b in range(a):
+                if self.independent(a, b):
+                    mask |= 1 << b
+            self.commutes.append(mask)
+
+        # Heuristics built for this book, see make_heuristic().
+        self.heuristics = {}
+
+        # (state, after) -> successors, least recently used first; see cache_successors().
+        self.cache = None
+        self.cache_size = 0
+
+    # Keeps the successors of up to size recently expanded states, so states that come up
+    # again, in a later search or a later query of the same batch, are not expanded twice.
+    # A size of 0 turns the cache off.
+    def cache_successors(self, size):
+        self.cache = OrderedDict() if size else None
+        self.cache_size = size
+
+    # The cache is only worth anything in the process that filled it.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['cache'] = OrderedDict() if self.cache is not None else None
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    def independent(self, a, b):
+        for i in range(len(self.items)):
+            if self.produce[a][i] and (self.produce[b][i] or self.consume[b][i] or self.require[b][i]):
+                return False
+            if self.produce[b][i] and (self.consume[a][i] or self.require[a][i]):
+                return False
+            if self.require[a][i] and self.consume[b][i] or self.require[b][i] and self.consume[a][i]:
+                return False
+        return True
+
+    # Ids of every recipe that can run on the given counts.
+    # With after, the id of the recipe that made these counts, recipes that commute with it
+    # and come before it are left out: the plans that run them first already get there.
+    def applicable(self, counts, after = None):
+        skip = self.commutes[after] if after is not None else 0
+        result = []
+        for r, need in enumerate(self.need):
+            if skip >> r & 1:
+                continue
+            for i, amount in need:
+                if counts[i] < amount:
+                    break
+            else:
+                result.append(r)
+        return result
+
+    # The ids of applicable() as a bitmask.
+    def applicable_mask(self, counts):
+        mask = 0
+        for r, need in enumerate(self.need):
+            for i, amount in need:
+                if counts[i] < amount:
+                    break
+            else:
+                mask |= 1 << r
+        return mask
+
+    # Expands a state in one pass: [(recipe id, next state)] for every applicable recipe.
+    # Every next state remembers its parent's applicable recipes and the recipe run to make
+    # it, in next_state.made. When it is expanded in turn, its own applicable recipes are
+    # worked out from those by rechecking only gained_by[r] and lost_by[r], so an expansion
+    # costs what the recipe run changed rather than the size of the book.
+    # This changes state: its made is cleared once used, so it does not keep the parent's
+    # mask alive. States handed out before, from the cache as well, are affected the same
+    # way; expanding one of them again only means a full scan of the book for it.
+    def successors(self, state, after = None):
+        cache = self.cache
+        if cache is not None:
+            key = (state, after)
+            result = cache.get(key)
+            if result is not None:
+                cache.move_to_end(key)
+                return result
+
+        counts = state.counts
+        need = self.need
+        made = state.made
+        state.made = None
+        if made is None:
+            mask = self.applicable_mask(counts)
+        else:
+            mask, r = made
+            # Recipes that were out and may now run, and recipes that ran and may not any more.
+            check = self.gained_by[r] & ~mask | self.lost_by[r] & mask
+            mask &= ~check
+            while check:
+                low = check & -check
+                check ^= low
+                for i, amount in need[low.bit_length() - 1]:
+                    if counts[i] < amount:
+                        break
+                else:
+                    mask |= low
+
+        todo = mask & ~self.commutes[after] if after is not None else mask
+        result = []
+        while todo:
+            low = todo & -todo
+            todo ^= low
+            r = low.bit_length() - 1
+            next_counts = list(counts)
+            for i, change in self.changes[r]:
+                next_counts[i] += change
+            next_state = State.from_counts(next_counts)
+            next_state.made = (mask, r)
+            result.append((r, next_state))
+
+        if cache is not None:
+            cache[key] = result
+            if len(cache) > self.cache_size:
+                cache.popitem(last = False)
+        return result
+
+    # [(recipe id, times, next state)] for running each applicable recipe as often as the
+    # inputs in counts allow, but only while some product is still below its caps entry
+    # (see item_caps()). Only batches of at least two runs are listed.
+    def batch_successors(self, state, caps):
+        counts = state.counts
+        result = []
+        for r in self.applicable(counts):
+            gains = self.gains[r]
+            if not gains:
+                continue
+            times = max([-(-(caps[i] - counts[i]) // amount) for i, amount in gains])
+            for i, amount in enumerate(self.consume[r]):
+                if amount:
+                    times = min(times, counts[i] // amount)
+            if times < 2:
+                continue
+            next_counts = list(counts)
+            for i, change in self.changes[r]:
+                next_counts[i] += times * change
+            result.append((r, times, State.from_counts(next_counts)))
+        return result
+
+    # Same as successors() but under the delete relaxation, where nothing is consumed.
+    def relaxed_successors(self, state):
+        counts = state.counts
+        result = []
+        for r in self.applicable(counts):
+            next_counts = list(counts)
+            for i, amount in self.gains[r]:
+                next_counts[i] += amount
+            result.append((r, State.from_counts(next_counts)))
+        return result
+
+# The most of each item that can matter for reaching goal: holding more than that is the
+# same as holding exactly that much. Items that no recipe consumes are only ever required,
+# so beyond what the goal asks for one is as good as many; items that are neither consumed
+# nor required only count towards the goal. Consumed items are unbounded.
+def item_bounds(book, goal):
+    bounds = []
+    for i, item in enumerate(book.items):
+        wanted = goal.get(item, 0)
+        if any(consume[i] for consume in book.consume):
+            bounds.append(inf)
+        elif any(require[i] for require in book.require):
+            bounds.append(max(1, wanted))
+        else:
+            bounds.append(wanted)
+    return tuple(bounds)
+
+# The most of each item worth making for goal: the largest amount any one recipe consumes
+# plus what the goal asks for, one of an item that is only ever required (a bench, a
+# pickaxe), and just the goal amount of anything nothing uses. Once an item is at its cap
+# the next recipe that uses it can always run, so there is no need to make more of it.
+def item_caps(book, goal):
+    caps = []
+    for i, item in enumerate(book.items):
+        wanted = goal.get(item, 0)
+        consumed = max([consume[i] for consume in book.consume] or [0])
+        if consumed:
+            caps.append(consumed + wanted)
+        elif any(require[i] for require in book.require):
+            caps.append(max(1, wanted))
+        else:
+            caps.append(wanted)
+    return tuple(caps)
+
+# True when recipe r, which led to counts, only made items that were already at their cap.
+def past_caps(book, caps, r, counts):
+    delta = book.delta[r]
+    for i, amount in book.gains[r]:
+        if counts[i] - delta[i] < caps[i]:
+            return False
+    return True
+
+# counts with every item clipped to its bound.
+def clip_counts(counts, bounds):
+    return tuple([count if count <= bound else bound for count, bound in zip(counts, bounds)])
+
+# The part of a crafting json that can matter for goal (its 'Goal' by default), worked
+# out backwards from the goal: a recipe is relevant when it makes a goal item or an item
+# some relevant recipe consumes or requires, and only the goal items and what relevant
+# recipes need are kept as items. The others can never be on a shortest plan, since
+# all they do is make things nothing on the way to the goal uses. Whatever relevant
+# recipes make besides is dropped from them, and the initial inventory is cut down to the
+# kept items too. Plans for it are plans for the whole json (see search_relevant()).
+def prune_crafting(Crafting, goal = None):
+    if goal is None:
+        goal = Crafting['Goal']
+    recipes = Crafting['Recipes']
+    relevant = set(goal)
+    kept = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, rule in recipes.items():
+            if name in kept or not any(item in relevant for item in rule.get("Produces", {})):
+                continue
+            kept.add(name)
+            changed = True
+            relevant.update(rule.get("Consumes", {}))
+            relevant.update(rule.get("Requires", {}))
+
+    pruned = {}
+    for name, rule in recipes.items():
+        if name in kept:
+            rule = dict(rule)
+            rule["Produces"] = {item: amount for item, amount in rule["Produces"].items() if item in relevant}
+            pruned[name] = rule
+    return {
+        'Items': [item for item in Crafting['Items'] if item in relevant],
+        'Initial': {item: amount for item, amount in Crafting.get('Initial', {}).items() if item in relevant},
+        'Goal': dict(goal),
+        'Recipes': pruned,
+    }
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+############ END OF RECIPE COMPILATION RELATED FUNCTIONS ####################
+#############################################################################
+
+
 #############################################################################
 ################ PATH LEARNING RELATED FUNCTIONS ############################
 #vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
@@ -121,6 +912,8 @@ def updateRequired(cook_book):
             requirements = entry.requires.keys()
             for requirement_key in requirements:
                 required_cook_book_entry = next((e for e in cook_book if e.ProductName == requirement_key), None)
+                # Nothing makes it (it can only come from the initial inventory).
+                if required_cook_book_entry is None: continue
                 if required_cook_book_entry.catalyst: continue
                 required_cook_book_entry.catalyst = True
                 required_cook_book_entry.effector.required = True
@@ -130,7 +923,7 @@ def updateRequired(cook_book):
 #Decides whether a cook book entry is primitive, aka, doesnt require or consume anything.
 def isPrimitive(cook_book_entry):
     if cook_book_entry.requires == None and cook_book_entry.consumes == None:
-        print("{} is a primitive!".format(cook_book_entry.name))
+        log.debug("%s is a primitive!", cook_book_entry.name)
         return True
     return False
 
@@ -143,7 +936,7 @@ def use_paths_get_goal(cook_book, state, goal):
         for key in goal.keys():
             if current_state[key] < goal[key]:
                 cook_book_entry = next((entry for entry in cook_book if entry.ProductName == key), None)
-                print("Making {} from current state:{}".format(cook_book_entry.name, current_state))
+                log.info("Making %s from current state: %s", cook_book_entry.name, current_state)
                 current_state = walk_path(current_state, cook_book_entry.path, goal)
     return current_state
 
@@ -156,7 +949,7 @@ def walk_path(state, path, goal):
         if effect.required and  state[effect.creates] >= 1 and effect.creates not in goal.keys():
             continue
         current_state = effect(current_state)
-        print(current_state)
+        log.debug("%s", current_state)
     return current_state
 
 # Creates a cook book entry.
@@ -172,10 +965,7 @@ def create_cookbook_entry(name, recipe, rule):
         newCookBookEntry.consumes = rule["Consumes"]
         consumes = True
 
-    if "Produces" in rule.keys():
-        newCookBookEntry.produces = rule["Produces"]
-        produces = True
-        #print("In {} updated produces ={}".format(name, rule["Produces"]))
+    newCookBookEntry.produces = rule.get("Produces", {})
 
 
     newCookBookEntry.updateProductName()
@@ -185,306 +975,490 @@ def create_cookbook_entry(name, recipe, rule):
 
 # The main engine. This basically learns all the shortests paths to all necesary
 # goals and updates the paths of those items as required.
+# It used to do this recursively through the cook book, which ignored Time and so did
+# not give the shortest paths; now every path is learned by search (learn_from_search)
+# from an empty inventory.
 def learn_shortest_paths(cook_book, goal):
-    # if goal is already known, return its path, and own effector added to it
-    # else check the components needed to make it and learn them
-    active_goals = list(goal.keys())
-
-    # Recursively learns.
-    # Takes a goal
-    # Learn(goal)
-    # Asks if I know how to build that goal (check if that entry attached with that goal has a path)
-    # If yes, return the path
-    # If no, look at what is necesary to build the object.
-    # Learn(sub_parts)
-    # repeat until you find a primitive action you already know.
-    # Now you know how to make the sub parts.
-    # If you know how to make the sub parts, you know how to make yourself by adding
-    #your own active effector to the list of paths that is contained in the subparts
-    # No you know how to get to the goal
-
-    # Unfortunately currently bugged as it doesnt take into consideration the time factor.
-    # I feel my work on this spread too far away from the spirit of the assignment so I stopped.
-    def learn(goal):
-        goal_entry = next((entry for entry in cook_book if entry.ProductName == goal ), None)
-        while not goal_entry.path:
-            for cook_book_entry in cook_book:
-                if goal == cook_book_entry.ProductName:
-                    if cook_book_entry.path:
-                       return cook_book_entry.path
-                    else:
-                        needed_list = []
-                        if cook_book_entry.requires:
-                            needed_list += list(cook_book_entry.requires.keys())
-                        if cook_book_entry.consumes:
-                            needed_list += list(cook_book_entry.consumes.keys())
-                        learning_path = []
-                        #print("Needed list in shortest_path:{}".format(needed_list))
-                        #print("Learning path in shortest_path:{}".format(learning_path))
-                        for needed in needed_list:
-                            needed_entry = next((entry for entry in cook_book if entry.ProductName == needed ), None)
-                            # If you already started learning the goal you dont need to start again.
-                            if not needed_entry.actively_learned:
-                                needed_entry.actively_learned = True
-                                learning_path += learn(needed)
-                            else:
-                                continue
-                        cook_book_entry.updatePath(learning_path)
-                        return cook_book_entry.path
-        return goal_entry.path
-
-    #Learn each goal.
-    for goal in active_goals:
-        learn(goal)
-    print("Learning complete.\n")
+    learn_from_search(cook_book, goal)
+    log.info("Learning complete.")
     return
 
-def composite_goal(cook_book, goals):
-    learn_list = []
-    for goal_key in goals.keys():
-        for entry in cook_book:
-            if entry.ProductName == goal_key:
-                learn_list.append()
-                return
-
-def learn_from_search(cook_book, goal):
-    return
+def find_cook_book_entry(cook_book, product):
+    return next((entry for entry in cook_book if entry.ProductName == product), None)
+
+# Indices of the items that can matter when making product: the product, and everything
+# needed (consumed or required) by a recipe producing an item that matters.
+def relevant_items(product):
+    relevant = {recipe_book.index[product]}
+    changed = True
+    while changed:
+        changed = False
+        for r, gains in enumerate(recipe_book.gains):
+            if any(i in relevant for i, amount in gains):
+                for i, amount in recipe_book.need[r]:
+                    if i not in relevant:
+                        relevant.add(i)
+                        changed = True
+    return relevant
+
+# Builds a Macro out of a list of recipe names by running them on counts: need is the
+# largest shortfall seen before any step, delta what the steps add up to.
+def make_macro(product, amount, names, cost):
+    width = len(recipe_book.items)
+    need = [0] * width
+    delta = [0] * width
+    for name in names:
+        r = recipe_book.ids[name]
+        for i, amount_needed in recipe_book.need[r]:
+            need[i] = max(need[i], amount_needed - delta[i])
+        for i, change in recipe_book.changes[r]:
+            delta[i] += change
+    return Macro(product, amount, names, cost, tuple(need), tuple(delta))
+
+# Names of the recipes in a path returned by search(), first step first.
+def path_recipe_names(path):
+    names = []
+    for state, action in reversed(path):
+        if action:
+            names.extend([action.creates] * getattr(action, 'times', 1))
+    return names
+
+# Learns (or reuses) an optimal macro for each item of goal, starting from state (an empty
+# inventory by default), and stores it in the item's cook book entry.
+# Only the items that can matter for making a product are part of the key, so the same
+# macro serves every inventory that agrees on those, and it is learned from that
+# projection of the inventory: the other items can not make it any cheaper.
+# Items no recipe makes are skipped, and all the searches together take no more than limit.
+def learn_from_search(cook_book, goal, state = None, limit = 30):
+    if state is None:
+        state = State()
+    start_time = time()
+    learned = {}
+    for product, amount in goal.items():
+        entry = find_cook_book_entry(cook_book, product)
+        # No recipe makes it, so there is nothing to learn.
+        if entry is None:
+            continue
+        if entry.relevant is None:
+            entry.relevant = relevant_items(product)
+        projected = State.from_counts([count if i in entry.relevant else 0 for i, count in enumerate(state.counts)])
+        key = (amount, projected.counts)
+
+        macro = entry.macros.get(key)
+        if macro is None:
+            product_goal = {product: amount}
+            path = search(graph, projected, make_goal_checker(product_goal), limit - (time() - start_time),
+                          heuristic, product_goal)
+            if path is None:
+                continue
+            names = path_recipe_names(path)
+            macro = make_macro(product, amount, names, sum(recipe_book.costs[recipe_book.ids[name]] for name in names))
+            entry.macros[key] = macro
+            entry.path = [EffectorWrapper(all_recipes[recipe_book.ids[name]].effect, name, all_recipes[recipe_book.ids[name]].cost)
+                          for name in names]
+        learned[product] = macro
+    return learned
+
+# Reaches a goal with several items by chaining the macro of each item that is still
+# short. A later macro can use up an earlier goal item (a bench eats planks), so it goes
+# round again until every item is satisfied or a round changes nothing.
+# Returns (recipe names, total Time), or None when some item has no macro. All the
+# learning together takes no more than limit.
+def composite_goal(cook_book, goals, state, limit = 30):
+    start_time = time()
+    goal_reached = make_goal_checker(goals)
+    current_state = state
+    steps = []
+    cost = 0
+    for attempt in range(len(goals) + 1):
+        if goal_reached(current_state):
+            return steps, cost
+        for product, amount in goals.items():
+            if current_state[product] >= amount:
+                continue
+            macro = learn_from_search(cook_book, {product: amount}, current_state, limit - (time() - start_time)).get(product)
+            if macro is None or not macro.applies(current_state):
+                return None
+            current_state = macro.apply(current_state)
+            steps += macro.steps
+            cost += macro.cost
+    return (steps, cost) if goal_reached(current_state) else None
+
+# search() seeded from the macro cache. A single item whose macro is cached is answered
+# straight from the cache; for several items the chained macros give a plan whose cost
+# bounds the search, which then only looks for something cheaper and falls back to the
+# chained plan if it finds nothing within the limit.
+def search_with_macros(cook_book, state, goal, limit):
+    start_time = time()
+    goal_reached = make_goal_checker(goal)
+    if goal_reached(state):
+        return []
+
+    seeded = composite_goal(cook_book, goal, state, limit)
+    if seeded is None:
+        return search(graph, state, goal_reached, limit, heuristic, goal)
+    steps, cost = seeded
+    if len(goal) == 1:
+        return replay_path(state, steps)
+
+    path = search(graph, state, goal_reached, limit - (time() - start_time), heuristic, goal, bound = cost)
+    if path:
+        return path
+    return replay_path(state, steps)
 #^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
 ################# END OF LEARNING RELATED FUNCTIONS #######################
 #############################################################################
 
 
+#############################################################################
+################ PLAN STORE RELATED FUNCTIONS ###############################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# A hash of everything in the crafting json that decides what a plan is: the items and
+# the recipes. The initial inventory and the goal are not part of it, they are the key.
+def recipe_fingerprint(crafting):
+    recipe_set = {'Items': crafting['Items'], 'Recipes': crafting['Recipes']}
+    return hashlib.sha256(json.dumps(recipe_set, sort_keys=True).encode('utf-8')).hexdigest()
+
+# An inventory (a State or a plain dict) as canonical json, leaving out zero amounts.
+def inventory_key(inventory):
+    return json.dumps({item: amount for item, amount in inventory.items() if amount}, sort_keys=True)
+
+# Plans kept on disk between runs, in a SQLite file.
+# Every plan is stored under the fingerprint of the recipe set it was made for plus its
+# initial inventory and goal, as the list of recipe names and its total Time. Opening
+# the store for a recipe set throws away the plans of any other fingerprint, so when the
+# recipe file changes the old plans are invalidated without anyone having to ask.
+class PlanStore():
+
+    def __init__(self, path, crafting):
+        self.fingerprint = recipe_fingerprint(crafting)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "fingerprint TEXT NOT NULL, initial TEXT NOT NULL, goal TEXT NOT NULL, "
+                "steps TEXT NOT NULL, cost REAL NOT NULL, "
+                "PRIMARY KEY (fingerprint, initial, goal))")
+            self.connection.execute("DELETE FROM plans WHERE fingerprint != ?", (self.fingerprint,))
+
+    # (recipe names, cost) of the stored plan, or None.
+    def get(self, initial, goal):
+        row = self.connection.execute(
+            "SELECT steps, cost FROM plans WHERE fingerprint = ? AND initial = ? AND goal = ?",
+            (self.fingerprint, inventory_key(initial), inventory_key(goal))).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, initial, goal, steps, cost):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)",
+                (self.fingerprint, inventory_key(initial), inventory_key(goal), json.dumps(steps), cost))
+
+    def close(self):
+        self.connection.close()
+
+# The store file that goes with a recipe file, e.g. crafting.json -> crafting.plans.sqlite.
+def plan_store_path(recipe_path):
+    return os.path.splitext(recipe_path)[0] + '.plans.sqlite'
+
+# The stored plan for (state, goal) replayed as a path, or None when there is none that
+# can be trusted: the store is for another recipe set than the one loaded, a step can not
+# run, or the plan does not end at the goal.
+def stored_path(plan_store, state, goal):
+    if plan_store.fingerprint != loaded_fingerprint:
+        return None
+    stored = plan_store.get(state, goal)
+    if stored is None:
+        return None
+    current_state = state
+    for name in stored[0]:
+        recipe = all_recipes[recipe_book.ids[name]]
+        if not recipe.check(current_state):
+            return None
+        current_state = recipe.effect(current_state)
+    if not make_goal_checker(goal)(current_state):
+        return None
+    return replay_path(state, stored[0])
+
+# search(), but answered from the plan store when it already has the plan, and the plan
+# it finds is stored for next time. A failed search is not stored, since it may only have
+# run out of time. Nothing is stored when the store is for another recipe set.
+def search_with_store(plan_store, graph, state, is_goal, limit, heuristic, goal):
+    path = stored_path(plan_store, state, goal)
+    if path is not None:
+        return path
+
+    path = search(graph, state, is_goal, limit, heuristic, goal)
+    if path and plan_store.fingerprint == loaded_fingerprint:
+        plan_store.put(state, goal, path_recipe_names(path), path_cost(path))
+    return path
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+################# END OF PLAN STORE RELATED FUNCTIONS #######################
+#############################################################################
+
+
 #############################################################################
 ############ BI DIRECTIONAL A* RELATED FUNCTIONS ############################
 #vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
 
-def backwards_graph(state, all_states):
+def backwards_graph(state, all_states = None, after = None):
     # Iterates through all recipes/rules, checking which are valid in the given state.
     # If a rule is valid, it returns the rule's name, the resulting state after application
 
     # to the given state, and the cost for the rule.
+    # Here state is a need set and the resulting state is the need set regressed through the rule.
+    # after is the name of the recipe the need set was regressed through last; recipes that
+    # commute with it and come before it in the recipe book are skipped, as in graph().
+    skip = recipe_book.commutes[recipe_book.ids[after]] if after is not None else 0
     all_nodes = []
-    for r in all_backwards_recipes:
+    for index, (r, effector_wrapper) in enumerate(zip(all_backwards_recipes, backwards_effectors)):
+        if skip >> index & 1:
+            continue
         if r.check(state):
+            next_state = r.effect(state)
             # This ensure we dont go through duplicate paths.
-            if r.effect(state) in all_states:
-                continue
-            all_states.add(r.effect(state))
-            effector_wrapper = EffectorWrapper(r.effect, r.name, r.cost)
-            all_nodes.append(Node(r.name, r.effect(state), r.cost, effector_wrapper))
+            if all_states is not None:
+                if next_state in all_states:
+                    continue
+                all_states.add(next_state)
+            all_nodes.append(Node(r.name, next_state, r.cost, effector_wrapper))
     return all_nodes
 
-def make_backwards_checker(rule):
-    # Implement a function that returns a function to determine whether a state meets a
-    # rule's requirements. This code runs once, when the rules are constructed before
-    # the search is attempted.
-
-    #print("Printing rule: {}".format(rule))
-    #{'Produces': {'stone_axe': 1}, 'Requires': {'bench': True}, 'Consumes': {'cobble': 3, 'stick': 2}, 'Time': 1}
-    #The checker’s role is to assess whether a crafting recipe is valid in a given state.
-    #State is the stuff you have.
-
-    #{'bench': True}
-    #{'plank': 3, 'stick': 2}
-    def backwards_check(state):
-        # This code is called by graph(state) and runs millions of times.
-        # Tip: Do something with rule['Consumes'] and rule['Requires'].
-
-        requires = None
-        produces = None
-        if "Requires" in rule:
-            requires = rule["Requires"]
-        if "Produces" in rule:
-            produces = rule["Produces"]
-
-
-        #if it consumes any items
-        if produces:
-            for produced, amount in produces.items():
-                if produced not in state:
-                    return False
-                if not (amount <= state[produced]):
-                    return False
-        # same as above
-
-        if requires:
-            for required in requires:
-                if not required in state:
-                    return False
-                if state[required] < 1:
-                    return False
+# Searching backwards works on need sets instead of inventories: a State holding the least
+# amount of each item from which the rest of the plan still reaches the goal. The goal
+# itself is the first need set, and any inventory that has at least the amounts of a need
+# set can finish the plan from there. The backwards checker and effector of each recipe
+# are generated by recipe_source().
 
+# True when the inventory state_1 has everything the need set state_2 asks for.
+def bi_goal(state_1, state_2):
+    for have, need in zip(state_1.counts, state_2.counts):
+        if have < need:
+            return False
+    return True
+
+# Forward A* from the initial inventory and backward search from the goal's need set at
+# the same time. Each step expands whichever side has the smaller frontier, and every
+# generated state is checked against the other side through a DominanceIndex: the
+# frontiers meet as soon as a forward inventory has everything some backward need set
+# asks for, not only when the two are equal. The search stops once no cheaper meeting is
+# possible, when the cheapest open costs of the two sides add up to the best meeting.
+# heuristic is only used to prune forward states (an infinite value skips the state).
+# stats is an optional SearchStats, counting both sides together.
+def bi_search(graph, state, is_goal, limit, heuristic, goal, stats = None):
 
-        #Reaching here means we have all of what we need
-        return True
+        if is_goal(state):
+            return []
 
-    return backwards_check
+        start_time = time()
+        if stats is not None:
+            stats.start()
+            heuristic = stats.timed(heuristic)
+
+        init_node = Node("Initial inventory.", state, 0)
+        goal_state = State(goal)
+        goal_node = Node("Goal State.", goal_state, 0)
+
+        # Everything below is kept per side: True is forward, False is backward.
+        queues = {True: OpenList(), False: OpenList()}
+        distances = {True: {state: 0}, False: {goal_state: 0}}
+        closed_sets = {True: set(), False: set()}
+        # The node each state was last reached with, for the backpointers.
+        nodes = {True: {state: init_node}, False: {goal_state: goal_node}}
+        frontier_index = {True: DominanceIndex(by_support = False), False: DominanceIndex(by_support = False)}
+        frontier_index[True].add(state.counts, state)
+        frontier_index[False].add(goal_state.counts, goal_state)
 
-def make_backwards_effector(rule):
-    # Implement a function that returns a function which transitions from state to
-    # new_state given the rule. This code runs once, when the rules are constructed
-    # before the search is attempted.
+        # The dictionary that will store the backpointers
+        backpointers = {}
+        backpointers[init_node] = None
+        backpointers[goal_node] = None
 
-    #The effector’s function is
-    #to return the state resulting from applying the rule to a given state.
-    def backwards_effect(state):
-        # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
-
-        #Copy the state.
-        next_state = state.copy()
-        consumes_list = None
-        produces_list = None
-        if "Consumes" in rule:
-            consumes_list = rule["Consumes"].items()
-        if "Produces" in rule:
-            produces_list = rule["Produces"].items()
-
-        #Update the sate by consuming the amount of items
-        if consumes_list:
-            for consumed, amount in consumes_list:
-                if consumed in next_state.keys():
-                    next_state[consumed] += amount
-                else:
-                    next_state[consumed] = amount
+        queues[True].push(state, 0, init_node)
+        queues[False].push(goal_state, 0, goal_node)
 
-        #add the amount of items produced to state.
-        if produces_list:
-            for produced, amount in produces_list:
-                next_state[produced] -= amount
+        best_cost = inf
+        meeting = None
 
-        return next_state
+        while time() - start_time < limit and queues[True] and queues[False]:
 
-    return backwards_effect
+            if queues[True].peek() + queues[False].peek() >= best_cost:
+                break
 
-def bi_goal(state_1, state_2):
-    s_1 = {key: value for key, value in state_1.items()
-             if value != 0}
-    s_2 = {key: value for key, value in state_2.items()
-             if value != 0}
+            forward = len(queues[True]) <= len(queues[False])
+            cost, current_state, current_node = queues[forward].pop()
+            closed_sets[forward].add(current_state)
+            current_cost = distances[forward][current_state]
 
-    if s_1 == s_2:
-        return True
-    return False
-"""
-    for item, amount in s_1.items():
-            #print("Printing item:{}".format(item))
-            #print("Printing amount :{}".format(amount))
-        if item not in s_2.keys():
-            return False
-        elif amount > s_2[item]:
-            return False
-"""
+            if forward:
+                children = graph(current_state)
+            else:
+                children = backwards_graph(current_state)
+            if stats is not None:
+                stats.expand(current_state, len(queues[True]) + len(queues[False]))
+                stats.generated += len(children)
+
+            for child_node in children:
+                child_state = child_node.state
+                if child_state in closed_sets[forward]:
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
 
-def bi_search(graph, state, is_goal, limit, heuristic, goal):
+                tentative_cost = current_cost + child_node.cost
+                if tentative_cost >= distances[forward].get(child_state, inf):
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+                if forward and heuristic(child_node, goal) == inf:
+                    continue
 
-        if is_goal(state):
-            return []
+                distances[forward][child_state] = tentative_cost
+                nodes[forward][child_state] = child_node
+                backpointers[child_node] = current_node
+                queues[forward].push(child_state, tentative_cost, child_node)
+                frontier_index[forward].add(child_state.counts, child_state)
 
-        start_time = time()
-        queue = []
-        closed_set = []
+                # Meeting the other side: need sets this inventory satisfies, or
+                # inventories that satisfy this need set.
+                if forward:
+                    matches = frontier_index[False].covered_by(child_state.counts)
+                else:
+                    matches = frontier_index[True].covering(child_state.counts)
+                for other_state in matches:
+                    total_cost = tentative_cost + distances[not forward][other_state]
+                    if total_cost < best_cost:
+                        best_cost = total_cost
+                        meeting = (child_state, other_state) if forward else (other_state, child_state)
+
+        if meeting:
+            forward_state, need_set = meeting
+            path = join_bi_paths(init_node, backpointers, nodes[True][forward_state], nodes[False][need_set])
+            log.info("Found a path in %s seconds.", time() - start_time)
+            if stats is not None:
+                stats.solution(path)
+                stats.finish()
+            return path
 
-        current_state = state
-        current_node = Node("Initial inventory.", current_state, 0)
+        # Failed to find a path
+        if stats is not None:
+            stats.finish()
+        log.info("Failed to find a path from %s within the time limit (%s seconds).", state, time() - start_time)
+        return None
 
-        current_backwards_state = State({key: goal[key] for key in goal})
-        current_backwards_node = Node("Goal State.", current_backwards_state, 0)
+# The forward path up to the meeting inventory, followed by the backward half's rules run
+# forwards from there, in the same [(state, action)] format as reconstruct_path().
+def join_bi_paths(init_node, backpointers, forward_node, backward_node):
+    names = []
+    while backpointers[backward_node] is not None:
+        names.append(backward_node.name)
+        backward_node = backpointers[backward_node]
+    return replay_path(forward_node.state, names)[:-1] + reconstruct_path(init_node, backpointers, forward_node)
+
+
+# A* backwards only, from the goal's need set to any need set the initial inventory state
+# already has. Each step regresses a need set through a recipe that makes something it
+# still needs (see recipe_source()), so only recipes that matter for the goal are
+# ever looked at, and an inventory with any amount of spare items never comes up.
+# A need set is merged into one already expanded that asks for no more of any item at no
+# more cost: everything that reaches the bigger one reaches the smaller one too. These
+# subsumption checks go through a DominanceIndex.
+# mode is the relaxation heuristic estimating the cost of getting from state to each need
+# set; its table for state is only built once. With 'h_add' plans come back within
+# milliseconds even for goals like {'rail': 200}, though often dearer than search()'s;
+# with 'h_max' they are optimal, but only shallow goals finish in reasonable time.
+def regression_search(state, goal, limit, mode = 'h_add', book = None, stats = None):
 
+        start_time = time()
 
-        init_node = current_node
+        if book is None:
+            book = recipe_book
+        relaxation = make_heuristic(mode, book, {})
+        make = relaxation.table(state.counts)
+        initial = state.counts
 
-        distances = {}
-        distances[current_node] = 0
-        distances[current_backwards_node] = 0
+        def heuristic(need_set):
+            return relaxation.estimate(initial, [(i, amount) for i, amount in enumerate(need_set.counts) if amount], make)
 
-        all_states = set()
-        all_states.add(current_state)
+        if stats is not None:
+            stats.start()
+            heuristic = stats.timed(heuristic)
 
-        all_backwards_states = set()
-        all_backwards_states.add(current_backwards_state)
+        goal_set = State(goal)
+        if bi_goal(state, goal_set):
+            return []
 
-        # The dictionary that will store the backpointers
-        backpointers = {}
-        backpointers[current_node] = None
-        backpointers[current_backwards_node] = None
+        records = SearchRecords()
+        goal_id = records.intern(goal_set)
+        records.costs[goal_id] = 0
+        closed = records.closed
+        costs = records.costs
 
-        heappush(queue, (current_backwards_node.cost, current_backwards_node, False))
-        heappush(queue, (current_node.cost, current_node, True))
+        # Expanded need sets -> their cost.
+        expanded = DominanceIndex()
 
+        queue = OpenList()
+        queue.push(goal_id, heuristic(goal_set), goal_id)
 
-        # Implement your search here! Use your heuristic here!
-        # When you find a path to the goal return a list of tuples [(state, action)]
-        # representing the path. Each element (tuple) of the list represents a state
-        # in the path and the action that took you to this state
-        #print("Printing the state: {}".format(state))
-        #print("Printing the graph: {}".format(graph))
         while time() - start_time < limit and queue:
 
-            if bi_goal(current_state, current_backwards_state):
-                backwards_path = reconstruct_path(goal, backpointers, current_backwards_node)
-                path = reconstruct_path(init_node, backpointers, current_node)
-                backwards_path.reverse()
-                path += backwards_path
+            priority, current_id, current_id = queue.pop()
+            need_set = records.states[current_id]
+            current_cost = costs[current_id]
+
+            if bi_goal(state, need_set):
+                names = []
+                while current_id != goal_id:
+                    names.append(records.action_name(current_id))
+                    current_id = records.parents[current_id]
+                path = replay_path(state, names)
+                log.info("Found a path in %s seconds.", time() - start_time)
+                if stats is not None:
+                    stats.solution(path)
+                    stats.finish()
                 return path
 
-            #for cost, node in queue:
-            #    print("Name: {}, weight:{}".format(node.name, cost))
-            #print()
+            closed[current_id] = 1
+            if any(cost <= current_cost for cost in expanded.covered_by(need_set.counts)):
+                if stats is not None:
+                    stats.duplicates += 1
+                continue
+            expanded.add(need_set.counts, current_cost)
 
-            cost, node, forward = heappop(queue)
+            children = backwards_graph(need_set, after = records.action_name(current_id))
+            if stats is not None:
+                stats.expand(need_set, len(queue))
+                stats.generated += len(children)
 
+            for child_node in children:
+                child_set = child_node.state
+                tentative_cost = current_cost + child_node.cost
 
-            if forward:
-                current_node = node
-                current_state = node.state
-                closed_set.append(current_node)
-                for child_node in graph(current_state, all_states):
-                    if child_node in closed_set:
-                        continue
-                    child_node_cost = child_node.cost
-                    current_node_cost = distances[current_node]
-                    tentative_score = current_node_cost + child_node_cost + heuristic(child_node, current_backwards_state)
-                    if child_node not in distances or tentative_score <= distances[child_node]:
-                        distances[child_node] = tentative_score
-                        if tentative_score == inf:
-                            try:
-                                queue.remove(child_node)
-                            except ValueError:
-                                continue
-                        else:
-                            heappush(queue, (tentative_score, child_node, True))
-                    backpointers[child_node] = current_node
-                print("Printing current_state in search forward:{}".format(current_state))
-            else:
-                current_backwards_node = node
-                current_backwards_state = node.state
-                closed_set.append(current_backwards_node)
-                for child_node in backwards_graph(current_backwards_state, all_backwards_states):
-                    if child_node in closed_set:
-                        continue
-                    child_node_cost = child_node.cost
-                    current_backwards_node_cost = distances[current_backwards_node]
-                    tentative_score = current_backwards_node_cost + child_node_cost #+ heuristic(current_backwards_node, current_state)
-                    if child_node not in distances or tentative_score <= distances[child_node]:
-                        distances[child_node] = tentative_score
-                        if tentative_score == inf:
-                            try:
-                                queue.remove(child_node)
-                            except ValueError:
-                                print("value error")
-                                continue
-                        else:
-                            heappush(queue, (tentative_score, child_node, False))
-                    backpointers[child_node] = current_node
-                print("Printing current_state in search backwards:{}".format(current_backwards_state))
+                child_id = records.ids.get(child_set)
+                if child_id is not None and (closed[child_id] or tentative_cost >= costs[child_id]):
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+
+                child_heuristic = heuristic(child_set)
+                if child_heuristic == inf:
+                    continue
+
+                if child_id is None:
+                    child_id = records.intern(child_set)
+                records.record(child_id, current_id, child_node, tentative_cost)
+                queue.push(child_id, tentative_cost + child_heuristic, child_id)
 
         # Failed to find a path
-        #print(time() - start_time, 'seconds.')
-        print("Failed to find a path from", state, 'within time limit in heuristic.')
+        if stats is not None:
+            stats.finish()
+        log.info("Failed to find a path from %s within the time limit (%s seconds).", state, time() - start_time)
         return None
 
-
 #^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
 ############# END BI DIRECTIONAL A* RELATED FUNCTIONS #######################
 #############################################################################
@@ -504,22 +1478,21 @@ def make_relaxed_effector(rule):
 
     #The effector’s function is
     #to return the state resulting from applying the rule to a given state.
-    def relaxed_effect(state):
-        # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
 
-        #Copy the state.
-        next_state = state.copy()
-        produces_list = None
-        if "Produces" in rule:
-            produces_list = rule["Produces"].items()
+    # Turn the rule into (position in the state, change in amount) pairs once, here,
+    # so the effector itself only has to add numbers to a list.
+    changes = defaultdict(int)
+    if "Produces" in rule:
+        for produced, amount in rule["Produces"].items():
+            changes[State.INDEX[produced]] += amount
+    changes = list(changes.items())
 
-        #add the amount of items produced to state.
-        if produces_list:
-            for produced, amount in produces_list:
-                next_state[produced] += amount
-
-        return next_state
+    def relaxed_effect(state):
+        # This code is called by graph(state) and runs millions of times
+        next_counts = list(state.counts)
+        for index, amount in changes:
+            next_counts[index] += amount
+        return State.from_counts(next_counts)
     return relaxed_effect
 
 def relaxed_graph(state):
@@ -527,78 +1500,307 @@ def relaxed_graph(state):
     # If a rule is valid, it returns the rule's name, the resulting state after application
 
     # to the given state, and the cost for the rule.
-    for r in all_recipes:
-        if r.check(state):
-            effector_wrapper = EffectorWrapper(r.relaxed_effect, r.name, r.cost)
-            yield Node(r.name, r.relaxed_effect(state), r.cost, r.relaxed_effect, effector_wrapper)
+    for r, next_state in recipe_book.relaxed_successors(state):
+        recipe = all_recipes[r]
+        yield Node(recipe.name, next_state, recipe.cost, relaxed_effectors[r])
 
 def relaxed_search(graph, state, is_goal, limit):
 
         start_time = time()
-        queue = []
-        closed_set = []
 
         current_state = state
         current_node = Node("Initial inventory.", current_state, 0)
         init_node = current_node
 
         distances = {}
-        distances[current_node] = 0
+        distances[current_state] = 0
 
         # The dictionary that will store the backpointers
         backpointers = {}
         backpointers[current_node] = None
 
-        for state_node in graph(current_state):
-            heappush(queue, (state_node.cost, state_node))
-            #print("Printing rule in search: {}".format(recipe))
+        closed_set = set()
+        queue = OpenList()
+        queue.push(current_state, 0, current_node)
 
         # Implement your search here! Use your heuristic here!
         # When you find a path to the goal return a list of tuples [(state, action)]
         # representing the path. Each element (tuple) of the list represents a state
         # in the path and the action that took you to this state
-        #print("Printing the state: {}".format(state))
-        #print("Printing the graph: {}".format(graph))
         while time() - start_time < limit and queue:
 
+            cost, current_state, current_node = queue.pop()
+
             if is_goal(current_state):
                 path = reconstruct_path(init_node, backpointers, current_node)
-                return -(len(path) + distances[current_node])
+                return -(len(path) + distances[current_state])
 
-            cost, current_node = heappop(queue)
-            current_state = current_node.state
-            closed_set.append(current_node)
+            closed_set.add(current_state)
 
             for child_node in relaxed_graph(current_state):
+                child_state = child_node.state
 
                 #Lets be safe.
-                if child_node in closed_set:
+                if child_state in closed_set:
                     continue
 
-                if child_node not in queue:
-                    heappush(queue, (child_node.cost, child_node))
-
-                tentative_score = current_node.cost + child_node.cost
-                if child_node not in distances or tentative_score <= distances[child_node]:
-                    distances[child_node] = tentative_score
-
-                backpointers[child_node] = current_node
+                tentative_score = distances[current_state] + child_node.cost
+                if tentative_score < distances.get(child_state, inf):
+                    distances[child_state] = tentative_score
+                    backpointers[child_node] = current_node
+                    queue.push(child_state, tentative_score, child_node)
 
             #print("Printing current_state in search:{}".format(current_state))
 
         # Failed to find a path
-        #print(time() - start_time, 'seconds.')
-        print("Failed to find a path from", state, 'within time limit in heuristic.')
+        log.info("Failed to find a relaxed path from %s within the time limit.", state)
         return 0
 
+# The relaxed planning graph behind relaxation_heuristic(). Instead of searching the
+# relaxed graph from scratch for every state, it keeps the reachability layers of the
+# items (the first layer each item can be held in, and the recipe that gets it there)
+# and only updates them when the set of held items changes.
+# Layers depend only on which items are held, so they are remembered per bitmask, and a
+# state that holds everything the last evaluated state held plus a few new items (the
+# usual case between siblings and their parent) starts from the last layers and only
+# lowers the items the new ones make reachable sooner.
+# The relaxed plan is extracted FF style: walking the layers down from the goal, each
+# missing item is made by its recorded recipe, as many times as the demand for it needs.
+class RelaxedPlanningGraph():
+
+    def __init__(self, book, goal):
+        self.book = book
+        self.goal = [(book.index[item], amount) for item, amount in goal.items()]
+        self.inputs = [tuple(i for i, amount in need) for need in book.need]
+
+        # item -> recipes that need it, so an item dropping to a lower layer only
+        # revisits the recipes it feeds.
+        self.feeds = [[] for item in book.items]
+        for r, inputs in enumerate(self.inputs):
+            for i in inputs:
+                self.feeds[i].append(r)
+
+        # mask of held items -> (layer of each item, recipe that reaches it first,
+        # items with a recipe from the highest layer down)
+        self.layers = {}
+        self.last_mask = None
+
+    def build(self, mask):
+        book = self.book
+        width = len(book.items)
+        last = self.layers.get(self.last_mask)
+
+        if last is not None and mask & self.last_mask == self.last_mask:
+            # Only new items: start from the last layers and lower what they make reachable.
+            level, achiever = list(last[0]), list(last[1])
+            dirty = set()
+            for i in range(width):
+                if mask >> i & 1 and level[i]:
+                    level[i] = 0
+                    achiever[i] = None
+                    dirty.update(self.feeds[i])
+        else:
+            level = [0 if mask >> i & 1 else inf for i in range(width)]
+            achiever = [None] * width
+            dirty = set(range(len(book)))
+
+        while dirty:
+            next_dirty = set()
+            for r in dirty:
+                inputs = self.inputs[r]
+                reached = 1 + (max([level[i] for i in inputs]) if inputs else 0)
+                if reached == inf:
+                    continue
+                for i, amount in book.gains[r]:
+                    if reached < level[i] or (reached == level[i] and achiever[i] is not None
+                                              and book.costs[r] < book.costs[achiever[i]]):
+                        if reached < level[i]:
+                            next_dirty.update(self.feeds[i])
+                        level[i] = reached
+                        achiever[i] = r
+            dirty = next_dirty
+
+        # The items that have to be made, highest layer first.
+        order = sorted((i for i in range(width) if achiever[i] is not None), key=lambda i: -level[i])
+        self.layers[mask] = (level, achiever, order)
+        self.last_mask = mask
+        return self.layers[mask]
+
+    # The FF relaxed plan for the state as (number of actions, total Time).
+    def relaxed_plan(self, state):
+        book = self.book
+        counts = state.counts
+        mask = 0
+        for i, count in enumerate(counts):
+            if count:
+                mask |= 1 << i
+        layers = self.layers.get(mask)
+        if layers is None:
+            layers = self.build(mask)
+        else:
+            self.last_mask = mask
+        level, achiever, order = layers
+
+        demand = defaultdict(int)
+        for i, amount in self.goal:
+            if amount > counts[i]:
+                if level[i] == inf:
+                    return inf, inf
+                demand[i] = amount
+
+        length = 0
+        cost = 0
+        # Highest layer first, so all the demand on an item is known before it is made.
+        for i in order:
+            missing = demand[i] - counts[i]
+            if missing <= 0:
+                continue
+            r = achiever[i]
+            runs = -(-missing // dict(book.gains[r])[i])
+            length += runs
+            cost += runs * book.costs[r]
+            for j, amount in book.need[r]:
+                if book.consume[r][j]:
+                    demand[j] += runs * book.consume[r][j]
+                else:
+                    demand[j] = max(demand[j], 1)
+        return length, cost
+
+    # Used by search() as a heuristic: the Time cost of the relaxed plan.
+    def __call__(self, child_node, goal = None):
+        return self.relaxed_plan(child_node.state)[1]
+
+# One relaxed planning graph per goal, shared by every call for that goal.
+RELAXED_PLANNING_GRAPHS = {}
+
+# Relaxed plan length plus its Time cost. limit is what the old version spent searching
+# the relaxed graph; the planning graph needs no time limit and ignores it.
 def relaxation_heuristic(state, goal, limit = 0.1): #take goal here.
+    key = tuple(sorted(goal.items()))
+    planning_graph = RELAXED_PLANNING_GRAPHS.get(key)
+    if planning_graph is None:
+        planning_graph = RelaxedPlanningGraph(recipe_book, goal)
+        RELAXED_PLANNING_GRAPHS[key] = planning_graph
+    length, time_cost = planning_graph.relaxed_plan(state)
+    return length + time_cost
+
+# h_max / h_add: the delete relaxation heuristics, computed from the recipe book instead
+# of by searching the relaxed graph.
+# Under the relaxation an item is either held or not, so the cost of making any item
+# only depends on which items a state holds, not how many. Those per item cost tables
+# are built once for each combination of held items (kept as a bitmask) and then reused
+# by every state with the same combination, which makes evaluating a state a mask and a
+# few lookups.
+# 'h_max' combines the cost of a recipe's inputs with max and is admissible, so search
+# stays optimal. 'h_add' sums them instead; it is not admissible but guides the search
+# much more greedily.
+class RelaxationHeuristic():
+
+    def __init__(self, book, goal, mode = 'h_max'):
+        if mode not in ('h_max', 'h_add'):
+            raise ValueError("Unknown relaxation heuristic {}".format(mode))
+        self.book = book
+        self.mode = mode
+        self.goal = [(book.index[item], amount) for item, amount in goal.items()]
+
+        # To get n more of an item, at least ceil(n / most_made) producing recipes
+        # have to run, and each of them takes at least fastest time.
+        width = len(book.items)
+        self.most_made = [0] * width
+        self.fastest = [inf] * width
+        for r, gains in enumerate(book.gains):
+            for i, amount in gains:
+                self.most_made[i] = max(self.most_made[i], amount)
+                self.fastest[i] = min(self.fastest[i], book.costs[r])
+
+        # The items each recipe needs, with how many runs of a producer it takes to make
+        # that many of them (only h_add uses the runs), and what each recipe makes.
+        self.inputs = [tuple((i, -(-amount // max(self.most_made[i], 1))) for i, amount in need)
+                       for need in book.need]
+        self.outputs = book.gains
+
+        # mask of held items -> cost of making one more of each item
+        self.tables = {}
+
+    # Fills in the cost of making one more of each item, given which items are held.
+    def make_table(self, mask):
+        book = self.book
+        width = len(book.items)
+
+        # Cost of having an item: free if it is held, otherwise the cost of making it.
+        have = [0 if mask >> i & 1 else inf for i in range(width)]
+        make = [inf] * width
+
+        changed = True
+        while changed:
+            changed = False
+            for r, inputs in enumerate(self.inputs):
+                if self.mode == 'h_max':
+                    input_cost = max([have[i] for i, runs in inputs]) if inputs else 0
+                else:
+                    input_cost = sum([runs * have[i] for i, runs in inputs])
+                if input_cost == inf:
+                    continue
+                cost = book.costs[r] + input_cost
+                for i, amount in self.outputs[r]:
+                    if cost < make[i]:
+                        make[i] = cost
+                        if cost < have[i]:
+                            have[i] = cost
+                        changed = True
+
+        self.tables[mask] = make
+        return make
+
+    # The table for the items held in counts.
+    def table(self, counts):
+        mask = 0
+        for i, count in enumerate(counts):
+            if count:
+                mask |= 1 << i
+        make = self.tables.get(mask)
+        if make is None:
+            make = self.make_table(mask)
+        return make
+
+    def evaluate(self, state):
+        counts = state.counts
+        return self.estimate(counts, self.goal, self.table(counts))
+
+    # Estimated cost of getting from counts to the (item, amount) pairs in needs, with the
+    # table for counts.
+    def estimate(self, counts, needs, make):
+        result = 0
+        for i, amount in needs:
+            missing = amount - counts[i]
+            if missing <= 0:
+                continue
+            if make[i] == inf:
+                return inf
+            runs = -(-missing // self.most_made[i])
+            if self.mode == 'h_max':
+                result = max(result, make[i] + (runs - 1) * self.fastest[i])
+            else:
+                result += runs * make[i]
+        return result
+
+    # Same calling convention as heuristic(child_node, goal).
+    def __call__(self, child_node, goal = None):
+        return self.evaluate(child_node.state)
+
+# Builds one of the named relaxation heuristics for search(). They are kept on the recipe
+# book per goal, so every search for the same goal reuses the tables already built.
+def make_heuristic(name, book, goal):
+    key = (name, tuple(sorted(goal.items())))
+    built = book.heuristics.get(key)
+    if built is None:
+        if name == 'ff':
+            built = RelaxedPlanningGraph(book, goal)
+        else:
+            built = RelaxationHeuristic(book, goal, name)
+        book.heuristics[key] = built
+    return built
 
-    heuristic_result = inf
-    for product in state.keys():
-        if product not in goal.keys() and state[product] >= 1 and product in REQUIRED_ITEMS:
-            return heuristic_result
-    len_plus_time = relaxed_search(graph, state, is_goal, limit)
-    return len_plus_time
 
 #^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
 ################# END OF RELAXATION RELATED FUNCTIONS #######################
@@ -608,84 +1810,6 @@ def relaxation_heuristic(state, goal, limit = 0.1): #take goal here.
 ############## VANILLA SEARCH RELATED FUNCTIONS #############################
 #vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
 
-def make_checker(rule):
-    # Implement a function that returns a function to determine whether a state meets a
-    # rule's requirements. This code runs once, when the rules are constructed before
-    # the search is attempted.
-
-    #print("Printing rule: {}".format(rule))
-    #{'Produces': {'stone_axe': 1}, 'Requires': {'bench': True}, 'Consumes': {'cobble': 3, 'stick': 2}, 'Time': 1}
-    #The checker’s role is to assess whether a crafting recipe is valid in a given state.
-    #State is the stuff you have.
-
-    #{'bench': True}
-    #{'plank': 3, 'stick': 2}
-    def check(state):
-        # This code is called by graph(state) and runs millions of times.
-        # Tip: Do something with rule['Consumes'] and rule['Requires'].
-
-        consumes = None
-        requires = None
-        if "Consumes" in rule:
-            #List of tuples containing the consumed item and how many of is needed.
-            consumes = rule["Consumes"].items()
-            #List of required items (not consumed)
-        if "Requires" in rule:
-            requires = rule["Requires"]
-
-        #if it consumes any items
-        if consumes:
-            #check if we have the consumed items and necesary amount, if not return false
-            for consumed, amount in consumes:
-                if not (consumed in state and state[consumed] >= amount):
-                    return False
-
-        # same as above
-        if requires:
-            for required in requires:
-                if state[required] < 1:
-                    return False
-
-        #Reaching here means we have all of what we need
-        return True
-
-    return check
-
-def make_effector(rule):
-    # Implement a function that returns a function which transitions from state to
-    # new_state given the rule. This code runs once, when the rules are constructed
-    # before the search is attempted.
-
-    #The effector’s function is
-    #to return the state resulting from applying the rule to a given state.
-    def effect(state):
-        # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
-
-
-        #Copy the state.
-        next_state = state.copy()
-        consumes_list = None
-        produces_list = None
-        if "Consumes" in rule:
-            consumes_list = rule["Consumes"].items()
-        if "Produces" in rule:
-            produces_list = rule["Produces"].items()
-
-        #Update the sate by consuming the amount of items
-        if consumes_list:
-            for consumed, amount in consumes_list:
-                next_state[consumed] -= amount
-
-        #add the amount of items produced to state.
-        if produces_list:
-            for produced, amount in produces_list:
-                next_state[produced] += amount
-
-        return next_state
-
-    return effect
-
 def make_goal_checker(goal):
     # Implement a function that returns a function which checks if the state has
     # met the goal criteria. This code runs once, before the search is attempted.
@@ -704,111 +1828,296 @@ def make_goal_checker(goal):
 
     return is_goal
 
-def graph(state, all_states):
+def graph(state, all_states = None, after = None):
     # Iterates through all recipes/rules, checking which are valid in the given state.
     # If a rule is valid, it returns the rule's name, the resulting state after application
 
     # to the given state, and the cost for the rule.
+    # All the recipes are checked and applied in one pass over the compiled recipe book.
+    # When a set of all_states is given, states already in it are skipped and new ones are added.
+    # after is the name of the recipe that led to state; see RecipeBook.applicable().
     all_nodes = []
-    for r in all_recipes:
-        if r.check(state):
-            # This ensure we dont go through duplicate paths.
-            if r.effect(state) in all_states:
+    if after is not None:
+        after = recipe_book.ids.get(after)
+    for r, next_state in recipe_book.successors(state, after):
+        # This ensure we dont go through duplicate paths.
+        if all_states is not None:
+            if next_state in all_states:
                 continue
-            all_states.add(r.effect(state))
-            effector_wrapper = EffectorWrapper(r.effect, r.name, r.cost)
-            all_nodes.append(Node(r.name, r.effect(state), r.cost, effector_wrapper))
+            all_states.add(next_state)
+        recipe = all_recipes[r]
+        all_nodes.append(Node(recipe.name, next_state, recipe.cost, effectors[r]))
     return all_nodes
 
+# Wraps a graph function so that besides its nodes it also returns one node per recipe
+# that runs it as many times in a row as the inputs and the goal's item_caps() allow, named
+# "<recipe> x<times>" and costing times its Time. A few such steps replace long runs of the
+# same recipe, so quantity heavy goals are found at a fraction of the depth.
+def batched(graph, book, goal):
+    caps = item_caps(book, goal)
+    # (recipe id, times) -> the BatchEffector for it
+    batch_effectors = {}
+
+    def batch_graph(state, *args, **kwargs):
+        all_nodes = list(graph(state, *args, **kwargs))
+        for r, times, next_state in book.batch_successors(state, caps):
+            effector = batch_effectors.get((r, times))
+            if effector is None:
+                recipe = all_recipes[r]
+                effector = BatchEffector(make_repeated_effect(recipe.effect, times), recipe.name, times * recipe.cost, times)
+                batch_effectors[(r, times)] = effector
+            all_nodes.append(Node("{} x{}".format(effector.creates, times), next_state, effector.cost, effector))
+        return all_nodes
+
+    return batch_graph
+
+def make_repeated_effect(effect, times):
+    def repeated_effect(state):
+        for run in range(times):
+            state = effect(state)
+        return state
+    return repeated_effect
+
+# The same path with every batch step replaced by the single runs it is made of.
+def expand_batches(path):
+    return replay_path(path[-1][0], path_recipe_names(path))
+
 #Takes a state, which is a the inventory.
+# Prunes (returns inf for) any state reached by making more of items that were already at
+# their item_caps() for the goal. The caps are worked out once per goal.
 def heuristic(child_node, goal): #take goal here.
-    state = child_node.state
-    name = child_node.name
-    #produces = name_to_produces[child_node.name]
-    for product in state.keys():
-        if product not in goal.keys() and state[product] > 1 and product in REQUIRED_ITEMS:
-            #print("Triggered required item heuristic.")
-            return inf
-        if product not in goal.keys() and state[product] > 8:
-            #print("Triggered more than needed heuristic.")
-            return inf
+    r = recipe_book.ids.get(child_node.name)
+    if r is None:
+        return 0
+    key = ('caps', tuple(sorted(goal.items())))
+    caps = recipe_book.heuristics.get(key)
+    if caps is None:
+        caps = recipe_book.heuristics[key] = item_caps(recipe_book, goal)
+    if past_caps(recipe_book, caps, r, child_node.state.counts):
+        return inf
     return 0
 
-def search(graph, state, is_goal, limit, heuristic, goal):
+# heuristic is either a function called as heuristic(child_node, goal), or the name of one
+# of the relaxation heuristics built from book: 'h_max' (admissible), 'h_add' (greedy) or
+# 'ff' (the Time cost of the relaxed plan, greedy).
+# With a bound, only paths cheaper than it are looked for: anything whose cost plus
+# heuristic reaches the bound is pruned.
+# A weight above 1 orders the queue by g + weight * h instead, which finds a path much
+# sooner but not necessarily the cheapest one.
+# With caps (a tuple like item_caps() gives, or True to use item_caps() for goal), no recipe
+# runs whose every product is already at its cap.
+# With reduction, graph is called as graph(state, after = name of the recipe that led to
+# it), so only one order of every run of commuting recipes is generated.
+# With dominance, a state is also dropped when an expanded state held at least as much of
+# every item (clipped to item_bounds()) for no more cost: whatever the dropped state could
+# still do, the expanded one can do as well, so no cheaper path is lost. Each check is a
+# DominanceIndex query, so this trades time per expansion for fewer expansions: it can
+# halve them and still take longer.
+# stats is an optional SearchStats to count what the search does.
+# algorithm picks the search: 'astar' (this one), one that keeps memory bounded by budget,
+# 'ida' (ida_search) or 'sma' (sma_search), or 'regression' (regression_search, backwards
+# from the goal, which ignores graph and uses heuristic only if it names 'h_max' or
+# 'h_add', and 'h_add' otherwise). None of those take a bound, a weight or dominance.
+# 'bom' tries bill_of_materials() first (bom_search) and falls back to this search.
+# With batches, graph also gets batch steps (see batched()), and the path returned is
+# expanded back into single recipe runs.
+def search(graph, state, is_goal, limit, heuristic, goal, book = None, bound = inf, stats = None, weight = 1,
+           dominance = False, caps = None, reduction = False, algorithm = 'astar', budget = None, batches = False):
+
+        if algorithm == 'bom':
+            return bom_search(graph, state, is_goal, limit, heuristic, goal, book, stats, bound = bound, weight = weight,
+                              dominance = dominance, caps = caps, reduction = reduction, batches = batches)
+        if algorithm == 'regression':
+            return regression_search(state, goal, limit, heuristic if heuristic in ('h_max', 'h_add') else 'h_add',
+                                     book, stats)
+        if algorithm != 'astar':
+            if algorithm not in MEMORY_BOUNDED_SEARCHES:
+                raise ValueError("Unknown search algorithm {}".format(algorithm))
+            bounded_search, default_budget = MEMORY_BOUNDED_SEARCHES[algorithm]
+            return bounded_search(graph, state, is_goal, limit, heuristic, goal, book,
+                                  budget if budget is not None else default_budget, stats, caps, reduction)
 
         if is_goal(state):
             return []
 
         start_time = time()
-        queue = []
-        closed_set = []
 
-        current_state = state
-        current_node = Node("Initial inventory.", current_state, 0)
-        init_node = current_node
+        if book is None:
+            book = recipe_book
+        if isinstance(heuristic, str):
+            heuristic = make_heuristic(heuristic, book, goal)
 
-        distances = {}
-        distances[current_node] = 0
+        if caps is True:
+            caps = item_caps(book, goal)
 
-        all_states = set()
-        all_states.add(current_state)
+        if batches:
+            graph = batched(graph, book, goal)
 
-        # The dictionary that will store the backpointers
-        backpointers = {}
-        backpointers[current_node] = None
+        # Clipped counts of expanded states -> their cost.
+        if dominance:
+            bounds = item_bounds(book, goal)
+            expanded = DominanceIndex()
 
-        heappush(queue, (current_node.cost, current_node))
+        if stats is not None:
+            stats.start()
+            heuristic = stats.timed(heuristic)
+
+        # Every queued state, with its best known cost (g) and how it was reached. States
+        # are interned, so reaching the same inventory a second way is recognised as a
+        # duplicate, and everything else is kept by state id.
+        records = SearchRecords()
+        start_id = records.intern(state)
+        records.costs[start_id] = 0
+        closed = records.closed
+        costs = records.costs
+
+        # Ordered by f = g + h, and indexed by state id so a cheaper path to a queued
+        # state just lowers its priority instead of adding a second copy.
+        queue = OpenList()
+        queue.push(start_id, heuristic(Node("Initial inventory.", state, 0), goal), start_id)
 
         # Implement your search here! Use your heuristic here!
         # When you find a path to the goal return a list of tuples [(state, action)]
         # representing the path. Each element (tuple) of the list represents a state
         # in the path and the action that took you to this state
-        #print("Printing the state: {}".format(state))
-        #print("Printing the graph: {}".format(graph))
         while time() - start_time < limit and queue:
 
+            priority, current_id, current_id = queue.pop()
+            current_state = records.states[current_id]
+
             if is_goal(current_state):
-                path = reconstruct_path(init_node, backpointers, current_node)
-                print(time() - start_time)
+                path = records.path(current_id)
+                if batches:
+                    path = expand_batches(path)
+                log.info("Found a path in %s seconds.", time() - start_time)
+                if stats is not None:
+                    stats.solution(path)
+                    stats.finish()
                 return path
 
+            closed[current_id] = 1
+            current_node_cost = costs[current_id]
 
-            #for cost, node in queue:
-            #    print("Name: {}, weight:{}".format(node.name, cost))
-            #print()
+            if dominance:
+                clipped = clip_counts(current_state.counts, bounds)
+                if any(cost <= current_node_cost for cost in expanded.covering(clipped)):
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+                expanded.add(clipped, current_node_cost)
 
-            cost, current_node = heappop(queue)
-            current_state = current_node.state
+            if reduction:
+                children = graph(current_state, after = records.action_name(current_id))
+            else:
+                children = graph(current_state)
+            if stats is not None:
+                stats.expand(current_state, len(queue))
+                stats.generated += len(children)
 
-            closed_set.append(current_node)
+            for child_node in children:
+                child_state = child_node.state
+                tentative_cost = current_node_cost + child_node.cost
 
-            for child_node in graph(current_state, all_states):
+                child_id = records.ids.get(child_state)
                 #Lets be safe.
-                if child_node in closed_set:
+                if child_id is not None and (closed[child_id] or tentative_cost >= costs[child_id]):
+                    if stats is not None:
+                        stats.duplicates += 1
                     continue
 
-                child_node_cost = child_node.cost
-                current_node_cost = distances[current_node]
-                tentative_score = current_node_cost + child_node_cost + heuristic(child_node, goal)
-                if child_node not in distances or tentative_score <= distances[child_node]:
-                    distances[child_node] = tentative_score
-                    if tentative_score == inf:
-                        try:
-                            queue.remove(child_node)
-                        except ValueError:
-                            continue
-                    else:
-                        heappush(queue, (tentative_score, child_node))
+                if caps is not None:
+                    r = book.ids.get(child_node.name)
+                    if r is not None and past_caps(book, caps, r, child_state.counts):
+                        continue
 
-                backpointers[child_node] = current_node
+                # An infinite heuristic means the state is pruned, so it never enters the queue.
+                child_heuristic = heuristic(child_node, goal)
+                if tentative_cost + child_heuristic >= bound:
+                    continue
 
-            print("Printing current_state in search:{}".format(current_state))
+                if child_id is None:
+                    child_id = records.intern(child_state)
+                records.record(child_id, current_id, child_node, tentative_cost)
+                queue.push(child_id, tentative_cost + weight * child_heuristic, child_id)
 
         # Failed to find a path
-        print(time() - start_time, 'seconds.')
-        print("Failed to find a path from", state, 'within time limit in heuristic.')
+        if stats is not None:
+            stats.finish()
+        log.info("Failed to find a path from %s within the time limit (%s seconds).", state, time() - start_time)
         return None
 
+# Anytime version of search(): a generator that yields a first path as soon as a heavily
+# weighted search finds one, then strictly cheaper paths as the remaining time allows.
+# Each round reruns search() with the next, smaller weight, bounded by the cost of the best
+# path so far. The last weight should be 1; if that round finishes within the limit, and the
+# heuristic is admissible (like 'h_max'), the last path yielded is optimal.
+# Stops when the weights or the limit run out, so the caller can keep whichever path it
+# last got, or stop asking for more at any point.
+def anytime_search(graph, state, is_goal, limit, heuristic, goal, book = None, weights = (5, 3, 2, 1.5, 1), stats = None,
+                   dominance = False, caps = None, reduction = False):
+
+        if is_goal(state):
+            yield []
+            return
+
+        if isinstance(heuristic, str):
+            if book is None:
+                book = recipe_book
+            heuristic = make_heuristic(heuristic, book, goal)
+
+        start_time = time()
+        best_cost = inf
+        for weight in weights:
+            remaining = limit - (time() - start_time)
+            if remaining <= 0:
+                return
+            path = search(graph, state, is_goal, remaining, heuristic, goal, book, best_cost, weight = weight,
+                          dominance = dominance, caps = caps, reduction = reduction)
+            if path is None:
+                continue
+            best_cost = path_cost(path)
+            if stats is not None:
+                if stats.start_time is None:
+                    stats.start_time = start_time
+                stats.solution(path)
+                stats.finish()
+            log.info("Weight %s found a path of cost %s after %s seconds.", weight, best_cost, time() - start_time)
+            yield path
+
+# search() on just the part of Crafting relevant to goal (see prune_crafting()), so every
+# expansion checks fewer recipes and every state hashes fewer counts. The plan is then
+# replayed on the whole json from initial, which is left loaded (also when search()
+# raises), so the path returned is in the same full states as one from search().
+# initial and goal default to the json's 'Initial' and 'Goal'; options go to search() as
+# they are.
+def search_relevant(Crafting, limit, heuristic, initial = None, goal = None, **options):
+    if initial is None:
+        initial = Crafting.get('Initial', {})
+    pruned = prune_crafting(dict(Crafting, Initial = initial), goal)
+    load_recipes(pruned)
+    try:
+        state = State(pruned['Initial'])
+        path = search(graph, state, make_goal_checker(pruned['Goal']), limit, heuristic, pruned['Goal'], **options)
+    finally:
+        load_recipes(Crafting)
+    if path is None:
+        return None
+    return replay_path(State(initial), path_recipe_names(path))
+
+# Runs the named recipes from state and returns the path in the same [(state, action)]
+# format as reconstruct_path(), last state first.
+def replay_path(state, names):
+    path = [(state, None)]
+    for name in names:
+        r = recipe_book.ids[name]
+        state = all_recipes[r].effect(state)
+        path.insert(0, (state, effectors[r]))
+    return path
+
+# Total Time of a path.
+def path_cost(path):
+    return sum(action.cost for state, action in path if action)
+
 def reconstruct_path(init_node, cameFrom, current_node):
     total_path = [(current_node.state, current_node.effect)]
     while current_node in cameFrom.keys():
@@ -822,45 +2131,628 @@ def reconstruct_path(init_node, cameFrom, current_node):
 #############################################################################
 
 
-# The json file designates the initial state, and the goals.
-if __name__ == '__main__':
-    with open('crafting.json') as f:
-        Crafting = json.load(f)
+#############################################################################
+############## MEMORY BOUNDED SEARCH RELATED FUNCTIONS ######################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
 
-    # # List of items that can be in your inventory:
-    #print('All items:', Crafting['Items'])
-    #
-    # # List of items in your initial inventory with amounts:
-    #print('Initial inventory:', Crafting['Initial'])
-    #
-    # # List of items needed to be in your inventory at the end of the plan:
-    #print('Goal:',Crafting['Goal'])
-    #
-    # # Dict of crafting recipes (each is a dict):
-    #print('Example recipe:','craft stone_pickaxe at bench ->',Crafting['Recipes']['craft stone_pickaxe at bench'])
+# Both searches here take the same graph, heuristic and goal as search(), and the same
+# caps and reduction options, but keep a bounded amount of memory however long they run:
+# budget is the most transposition table entries (ida_search) or nodes (sma_search) kept.
+
+# The children of node, only in one order of every run of commuting recipes with reduction.
+def expand_node(graph, node, reduction):
+    if reduction:
+        return graph(node.state, after = node.name)
+    return graph(node.state)
+
+# IDA*: depth first searches with an increasing bound on f = g + h, each one starting at
+# the smallest f that went over the bound the time before. Only the current path is kept,
+# plus a transposition table of up to budget states with the cheapest cost they have
+# been reached at, so a state reached again for no less cost is not searched twice.
+def ida_search(graph, state, is_goal, limit, heuristic, goal, book = None, budget = 1000000, stats = None,
+               caps = None, reduction = False):
+
+        if is_goal(state):
+            return []
+
+        start_time = time()
+
+        if book is None:
+            book = recipe_book
+        if isinstance(heuristic, str):
+            heuristic = make_heuristic(heuristic, book, goal)
+        if caps is True:
+            caps = item_caps(book, goal)
+
+        if stats is not None:
+            stats.start()
+            heuristic = stats.timed(heuristic)
+
+        root = Node("Initial inventory.", state, 0)
+        threshold = heuristic(root, goal)
+
+        # state -> (cheapest cost it was reached at, the last iteration that reached it at that cost)
+        table = {}
+        iteration = 0
+
+        while threshold < inf:
+            iteration += 1
+            next_threshold = inf
+            table[state] = (0, iteration)
+
+            # The current path, the cost of each node on it and the children still to try.
+            path_nodes = [root]
+            path_costs = [0]
+            on_path = {state}
+            frontier = [iter(expand_node(graph, root, reduction))]
+
+            while frontier:
+                if time() - start_time >= limit:
+                    if stats is not None:
+                        stats.finish()
+                    log.info("Failed to find a path from %s within the time limit (%s seconds).", state, time() - start_time)
+                    return None
+
+                child_node = next(frontier[-1], None)
+                if child_node is None:
+                    frontier.pop()
+                    on_path.discard(path_nodes.pop().state)
+                    path_costs.pop()
+                    continue
+                if stats is not None:
+                    stats.generated += 1
+
+                child_state = child_node.state
+                if child_state in on_path:
+                    continue
+                tentative_cost = path_costs[-1] + child_node.cost
+
+                seen = table.get(child_state)
+                if seen is not None and (seen[0] < tentative_cost or seen[0] == tentative_cost and seen[1] == iteration):
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+
+                if caps is not None:
+                    r = book.ids.get(child_node.name)
+                    if r is not None and past_caps(book, caps, r, child_state.counts):
+                        continue
+
+                f = tentative_cost + heuristic(child_node, goal)
+                if f > threshold:
+                    if f < next_threshold:
+                        next_threshold = f
+                    continue
+
+                if seen is not None or len(table) < budget:
+                    table[child_state] = (tentative_cost, iteration)
+
+                if is_goal(child_state):
+                    path = [(child_state, child_node.effect)]
+                    for node in reversed(path_nodes):
+                        path.append((node.state, node.effect))
+                    log.info("Found a path in %s seconds.", time() - start_time)
+                    if stats is not None:
+                        stats.solution(path)
+                        stats.finish()
+                    return path
+
+                path_nodes.append(child_node)
+                path_costs.append(tentative_cost)
+                on_path.add(child_state)
+                frontier.append(iter(expand_node(graph, child_node, reduction)))
+                if stats is not None:
+                    stats.expand(child_state, len(frontier))
+
+            threshold = next_threshold
+
+        # Failed to find a path
+        if stats is not None:
+            stats.finish()
+        log.info("Failed to find a path from %s: nothing is left under any bound.", state)
+        return None
+
+# A node of the search tree sma_search() keeps in memory.
+# children counts the node's children still in memory, and forgotten is the lowest f of
+# the ones that were dropped to make room.
+class BoundedNode():
+    __slots__ = ('node', 'g', 'f', 'parent', 'depth', 'children', 'forgotten', 'live')
+
+    def __init__(self, node, g, f, parent):
+        self.node = node
+        self.g = g
+        self.f = f
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.children = 0
+        self.forgotten = inf
+        self.live = True
+
+# SMA*: A* over a search tree of at most budget nodes. When the tree outgrows the budget,
+# the leaf with the highest f (the shallowest of those) is dropped, and its parent
+# remembers the f it had. A parent that has lost all of its children becomes a leaf again,
+# with the lowest f it remembers, and is expanded again if that f comes up. With enough
+# budget to hold the cheapest path and the children of the nodes on it, the path found is
+# as cheap as search()'s would be; with less, it runs until the time limit.
+def sma_search(graph, state, is_goal, limit, heuristic, goal, book = None, budget = 100000, stats = None,
+               caps = None, reduction = False):
+
+        if is_goal(state):
+            return []
+
+        start_time = time()
+
+        if book is None:
+            book = recipe_book
+        if isinstance(heuristic, str):
+            heuristic = make_heuristic(heuristic, book, goal)
+        if caps is True:
+            caps = item_caps(book, goal)
+
+        if stats is not None:
+            stats.start()
+            heuristic = stats.timed(heuristic)
+
+        root_node = Node("Initial inventory.", state, 0)
+        root = BoundedNode(root_node, 0, heuristic(root_node, goal), None)
+        size = 1
+
+        # The tree node kept for each state, so a state is not kept twice for no less cost.
+        kept = {state: root}
+
+        # Leaves by (f, deepest first) to expand, and by (highest f, shallowest first) to
+        # drop. Entries go stale when a leaf is expanded, dropped or has its f changed; they
+        # are skipped when they come up, and the heaps are rebuilt when mostly stale.
+        leaves = []
+        worst = []
+        tie = 0
+
+        def add_leaf(leaf):
+            nonlocal tie
+            tie += 1
+            heappush(leaves, (leaf.f, -leaf.depth, tie, leaf))
+            heappush(worst, (-leaf.f, leaf.depth, tie, leaf))
+
+        def is_leaf(entry_f, leaf):
+            return leaf.live and leaf.children == 0 and entry_f == leaf.f
+
+        def drop(leaf):
+            nonlocal size
+            leaf.live = False
+            size -= 1
+            if kept.get(leaf.node.state) is leaf:
+                del kept[leaf.node.state]
+            parent = leaf.parent
+            if leaf.f < parent.forgotten:
+                parent.forgotten = leaf.f
+            parent.children -= 1
+            if parent.children == 0:
+                parent.f = parent.forgotten
+                parent.forgotten = inf
+                add_leaf(parent)
+
+        add_leaf(root)
+
+        while time() - start_time < limit and leaves:
+
+            f, depth, tie_breaker, current = heappop(leaves)
+            if not is_leaf(f, current):
+                continue
+            if f == inf:
+                break
+
+            current_state = current.node.state
+            if is_goal(current_state):
+                path = []
+                while current is not None:
+                    path.append((current.node.state, current.node.effect))
+                    current = current.parent
+                log.info("Found a path in %s seconds.", time() - start_time)
+                if stats is not None:
+                    stats.solution(path)
+                    stats.finish()
+                return path
+
+            children = expand_node(graph, current.node, reduction)
+            if stats is not None:
+                stats.expand(current_state, size)
+                stats.generated += len(children)
+
+            for child_node in children:
+                child_state = child_node.state
+                tentative_cost = current.g + child_node.cost
+
+                # Also catches the states on the path to current, which are all cheaper.
+                other = kept.get(child_state)
+                if other is not None and other.g <= tentative_cost:
+                    if stats is not None:
+                        stats.duplicates += 1
+                    continue
+
+                if caps is not None:
+                    r = book.ids.get(child_node.name)
+                    if r is not None and past_caps(book, caps, r, child_state.counts):
+                        continue
+
+                child_heuristic = heuristic(child_node, goal)
+                if child_heuristic == inf:
+                    continue
+
+                # A child never looks cheaper than its parent did (pathmax).
+                child = BoundedNode(child_node, tentative_cost, max(current.f, tentative_cost + child_heuristic), current)
+                current.children += 1
+                size += 1
+                kept[child_state] = child
+                add_leaf(child)
+
+            if current.children == 0:
+                # A dead end; nothing under it is worth keeping.
+                current.f = inf
+                if current.parent is None:
+                    break
+                drop(current)
+
+            while size > budget and worst:
+                f, depth, tie_breaker, leaf = heappop(worst)
+                if not is_leaf(-f, leaf) or leaf.parent is None:
+                    continue
+                drop(leaf)
+
+            if len(leaves) + len(worst) > 3 * size + 128:
+                live = [entry for entry in leaves if is_leaf(entry[0], entry[3])]
+                heapify(live)
+                leaves = live
+                live = [entry for entry in worst if is_leaf(-entry[0], entry[3])]
+                heapify(live)
+                worst = live
+
+        # Failed to find a path
+        if stats is not None:
+            stats.finish()
+        log.info("Failed to find a path from %s within the time limit (%s seconds).", state, time() - start_time)
+        return None
+
+# search(algorithm = name) -> (function, default budget)
+MEMORY_BOUNDED_SEARCHES = {
+    'ida': (ida_search, 1000000),
+    'sma': (sma_search, 100000),
+}
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+########## END OF MEMORY BOUNDED SEARCH RELATED FUNCTIONS ###################
+#############################################################################
+
+
+#############################################################################
+############## BILL OF MATERIALS RELATED FUNCTIONS ##########################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# Ids of the recipes that can ever run from counts: the ones whose every needed item is
+# held or made by another such recipe.
+def usable_recipes(book, counts):
+    have = {i for i, count in enumerate(counts) if count}
+    usable = set()
+    changed = True
+    while changed:
+        changed = False
+        for r, need in enumerate(book.need):
+            if r not in usable and all(i in have for i, amount in need):
+                usable.add(r)
+                have.update(i for i, amount in book.gains[r])
+                changed = True
+    return usable
+
+# Plans goal from state without searching, when the goal is a tree of demands: every item
+# it takes has exactly one usable producer, and no item takes itself, directly or through
+# the items it is made from or with. The demand for each item is then known exactly once
+# the demands for everything made from it are, so the items are visited in topological
+# order, the goal first. An item's producer runs just often enough for the demand, rounded
+# up to whole batches, and adds its runs times what it consumes to the demand for those
+# items, and one of each item it only requires (a tool is made once however often it is
+# used). Running the producers in the opposite order, raw items first, makes each item
+# before anything that uses it. Returns the recipe names in order, which is also the
+# cheapest plan, or None when the goal is not a tree like that. Counting runs item by item
+# is only exact when every producer that runs makes just one item of the tree and no item
+# is both used up and used as a tool, so those goals get None as well: a recipe making two
+# of the items would be counted (and run) for each of them, and a tool can be used before
+# it is used up rather than made once more.
+# With alternatives, an item with several usable producers does not end it: the tree is
+# worked out for each of them (up to max_trees trees in all) and the cheapest plan is
+# returned. That plan uses one producer per item, so it can be dearer than search()'s.
+def bill_of_materials(book, state, goal, alternatives = False, max_trees = 256):
+    counts = state.counts
+    usable = usable_recipes(book, counts)
+    producers = defaultdict(list)
+    for r in usable:
+        for i, amount in book.gains[r]:
+            producers[i].append(r)
+
+    if not alternatives:
+        names = explode_demand(book, counts, goal, producers, {})
+        return names if isinstance(names, list) else None
+
+    best = None
+    best_cost = inf
+    trees = 0
+    pending = [{}]
+    while pending and trees < max_trees:
+        choices = pending.pop()
+        trees += 1
+        names = explode_demand(book, counts, goal, producers, choices)
+        if isinstance(names, list):
+            cost = sum(book.costs[book.ids[name]] for name in names)
+            if cost < best_cost:
+                best, best_cost = names, cost
+        elif names is not None:
+            for r in producers[names]:
+                chosen = dict(choices)
+                chosen[names] = r
+                pending.append(chosen)
+    return best
+
+# One tree of bill_of_materials(), with choices fixing the producer of some items.
+# Returns the recipe names, None when there is no such tree, or the first item found
+# with several producers and no choice made for it.
+def explode_demand(book, counts, goal, producers, choices):
+    # Every item the goal takes, with the recipe that makes it (None if it is held),
+    # found depth first so the items come out in topological order.
+    producer = {}
+    order = []
+    visiting = set()
+    undecided = []
+
+    def visit(i):
+        if i in producer:
+            return True
+        if i in visiting:
+            return False
+        visiting.add(i)
+        made_by = [choices[i]] if i in choices else producers.get(i, [])
+        if len(made_by) > 1:
+            undecided.append(i)
+            return False
+        if made_by:
+            r = made_by[0]
+            for j, amount in book.need[r]:
+                if not visit(j):
+                    return False
+            producer[i] = r
+        else:
+            producer[i] = None
+        visiting.discard(i)
+        order.append(i)
+        return True
+
+    for item, amount in goal.items():
+        i = book.index[item]
+        if amount > counts[i] and not visit(i):
+            return undecided[0] if undecided else None
+
+    # How much of each item is consumed, and whether anything needs it as a tool.
+    consumed = defaultdict(int)
+    required = set()
+    runs = {}
+    for i in reversed(order):
+        demand = consumed[i] + max(goal.get(book.items[i], 0), 1 if i in required else 0)
+        missing = demand - counts[i]
+        if missing <= 0:
+            continue
+        r = producer[i]
+        if r is None:
+            return None
+        made = book.produce[r][i]
+        runs[r] = -(-missing // made)
+        for j, amount in enumerate(book.consume[r]):
+            if amount:
+                consumed[j] += runs[r] * amount
+        for j, amount in enumerate(book.require[r]):
+            if amount:
+                required.add(j)
+    if any(consumed[i] for i in required):
+        return None
+    for r in runs:
+        if sum(1 for i, amount in book.gains[r] if i in producer) > 1:
+            return None
+
+    names = []
+    for i in order:
+        r = producer[i]
+        if r in runs:
+            names.extend([book.names[r]] * runs[r])
+    return names
+
+# Same arguments and result as search(): the plan from bill_of_materials() when the goal is
+# a tree of demands, and otherwise whatever search() finds, called with options. With
+# alternatives, see bill_of_materials().
+def bom_search(graph, state, is_goal, limit, heuristic, goal, book = None, stats = None, alternatives = False,
+               **options):
+        if book is None:
+            book = recipe_book
+        names = bill_of_materials(book, state, goal, alternatives)
+        if names is not None:
+            path = replay_path(state, names)
+            if is_goal(path[0][0]):
+                if stats is not None:
+                    stats.start()
+                    stats.solution(path)
+                    stats.finish()
+                return path
+        log.info("No bill of materials for %s, searching instead.", goal)
+        return search(graph, state, is_goal, limit, heuristic, goal, book, stats = stats, **options)
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+########## END OF BILL OF MATERIALS RELATED FUNCTIONS #######################
+#############################################################################
+
+
+#############################################################################
+############## RECIPE CODE GENERATION RELATED FUNCTIONS #####################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# Where the compiled code of generated recipe modules is kept between runs, one file per
+# recipe set named after its recipe_fingerprint(), RECIPE_CODE_VERSION and the Python
+# version. None turns the disk cache off. Only the RECIPE_CODE_FILES most recently used
+# files are kept.
+RECIPE_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+RECIPE_CODE_FILES = 64
+# Goes up with every change to what recipe_source() writes, so older cached code is not run.
+RECIPE_CODE_VERSION = 1
+
+# Python source for the checker and effector of every recipe in a crafting json, written
+# out as straight line code over state.counts with the item positions and amounts filled
+# in, e.g. "return c[3] >= 3 and c[9] >= 2 and c[0] >= 1". Besides check_<k> and
+# effect_<k> for the k-th recipe, it has backwards_check_<k> and backwards_effect_<k>, and
+# lists CHECKS, EFFECTS, BACKWARDS_CHECKS and BACKWARDS_EFFECTS of them in recipe order.
+# Backwards, running a recipe last only helps if it makes something the need set still
+# needs, and regressing a need set through it means what it produces no longer has to be
+# held beforehand, what it consumes has to be held on top of the rest, and what it
+# requires has to be held (at least one) but is not used up.
+# The code expects from_counts (State.from_counts) among its globals.
+def recipe_source(Crafting):
+    index = {item: i for i, item in enumerate(Crafting['Items'])}
+    lines = ['# Generated by cheating.py from the recipes of fingerprint {}.'.format(recipe_fingerprint(Crafting)), '']
+    for k, (name, rule) in enumerate(Crafting['Recipes'].items()):
+        consumes = [(index[item], amount) for item, amount in rule.get("Consumes", {}).items()]
+        requires = [index[item] for item in rule.get("Requires", {})]
+        produces = [(index[item], amount) for item, amount in rule.get("Produces", {}).items()]
+        changes = defaultdict(int)
+        for i, amount in consumes:
+            changes[i] -= amount
+        for i, amount in produces:
+            changes[i] += amount
+
+        tests = ['c[{}] >= {}'.format(i, amount) for i, amount in consumes] + ['c[{}] >= 1'.format(i) for i in requires]
+        # repr() keeps a name with a line break in it inside the comment.
+        lines += ['# {!r}'.format(name),
+                  'def check_{}(state):'.format(k),
+                  '    c = state.counts',
+                  '    return {}'.format(' and '.join(tests) or 'True'),
+                  '',
+                  'def effect_{}(state):'.format(k),
+                  '    c = list(state.counts)']
+        lines += ['    c[{}] {} {}'.format(i, '+=' if change > 0 else '-=', abs(change)) for i, change in changes.items() if change]
+        lines += ['    return from_counts(c)',
+                  '',
+                  'def backwards_check_{}(state):'.format(k),
+                  '    c = state.counts',
+                  '    return {}'.format(' or '.join('c[{}] > 0'.format(i) for i, amount in produces) or 'False'),
+                  '',
+                  'def backwards_effect_{}(state):'.format(k),
+                  '    c = list(state.counts)']
+        lines += ['    c[{0}] = c[{0}] - {1} if c[{0}] > {1} else 0'.format(i, amount) for i, amount in produces]
+        lines += ['    c[{}] += {}'.format(i, amount) for i, amount in consumes]
+        lines += ['    if c[{0}] < 1: c[{0}] = 1'.format(i) for i in requires]
+        lines += ['    return from_counts(c)', '']
+
+    count = len(Crafting['Recipes'])
+    for table, prefix in [('CHECKS', 'check'), ('EFFECTS', 'effect'),
+                          ('BACKWARDS_CHECKS', 'backwards_check'), ('BACKWARDS_EFFECTS', 'backwards_effect')]:
+        lines.append('{} = [{}]'.format(table, ', '.join('{}_{}'.format(prefix, k) for k in range(count))))
+    return '\n'.join(lines) + '\n'
+
+# The functions of recipe_source() for a crafting json, as a dict of its module globals.
+# Compiling the source costs ten times what writing it does, so the compiled code is
+# marshalled into RECIPE_CODE_DIR and loaded from there when an earlier run left it.
+# A cache that can not be read or written is skipped.
+def compile_recipes(Crafting):
+    path = None
+    code = None
+    if RECIPE_CODE_DIR is not None:
+        key = '{} {} {}'.format(recipe_fingerprint(Crafting), RECIPE_CODE_VERSION, MAGIC_NUMBER.hex())
+        path = os.path.join(RECIPE_CODE_DIR, 'recipes_{}.marshal'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]))
+        try:
+            with open(path, 'rb') as f:
+                code = marshal.load(f)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        code = compile(recipe_source(Crafting), '<recipes>', 'exec')
+        if path is not None:
+            save_recipe_code(path, code)
+    module = {'from_counts': State.from_counts}
+    exec(code, module)
+    return module
+
+# Writes code to path whole and then moves it into place, so worker processes loading the
+# same recipes at once never read half a file, and drops the least recently used files
+# past RECIPE_CODE_FILES.
+def save_recipe_code(path, code):
+    try:
+        os.makedirs(RECIPE_CODE_DIR, exist_ok = True)
+        partial = '{}.{}'.format(path, os.getpid())
+        with open(partial, 'wb') as f:
+            marshal.dump(code, f)
+        os.replace(partial, path)
+
+        cached = [os.path.join(RECIPE_CODE_DIR, name) for name in os.listdir(RECIPE_CODE_DIR)
+                  if name.startswith('recipes_') and name.endswith('.marshal')]
+        cached.sort(key = os.path.getmtime, reverse = True)
+        for old_path in cached[RECIPE_CODE_FILES:]:
+            os.remove(old_path)
+    except OSError:
+        pass
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+########## END OF RECIPE CODE GENERATION RELATED FUNCTIONS ##################
+#############################################################################
+
+
+#############################################################################
+################ LIBRARY RELATED FUNCTIONS ##################################
+#vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv#
+
+# Fingerprint of the recipe set load_recipes() last built the globals from.
+loaded_fingerprint = None
+
+# Builds everything the planner functions read as module globals (all_recipes,
+# all_backwards_recipes, their effectors, recipe_book, COOK_BOOK, REQUIRED_ITEMS,
+# name_to_produces) from a
+# crafting json with 'Items' and 'Recipes'. Loading the same recipe set again is free.
+# A RecipeBook already compiled from the same json can be passed in as book.
+def load_recipes(Crafting, book = None):
+    global all_recipes, all_backwards_recipes, recipe_book, COOK_BOOK, loaded_fingerprint
+    global effectors, backwards_effectors, relaxed_effectors
+
+    fingerprint = recipe_fingerprint(Crafting)
+    if fingerprint == loaded_fingerprint:
+        return
+
+    # Every state shares the item layout, so it has to be fixed before the effectors are built.
+    State.set_layout(Crafting['Items'])
 
     # Build rules
     all_recipes = []
     all_backwards_recipes = []
-    #count = 0
-    #Name of the item
-    #The recipe (produces, requires, consumes, time
-    rules = {}
+    # One EffectorWrapper per recipe, shared by every node the graph functions make for it.
+    effectors = []
+    backwards_effectors = []
+    relaxed_effectors = []
+    REQUIRED_ITEMS.clear()
+    name_to_produces.clear()
+    RELAXED_PLANNING_GRAPHS.clear()
+
+    # Straight line checkers and effectors generated for these recipes, in their order.
+    compiled = compile_recipes(Crafting)
 
     COOK_BOOK = []
-    for name, rule in Crafting['Recipes'].items():
-        checker = make_checker(rule)
-        effector = make_effector(rule)
+    for k, (name, rule) in enumerate(Crafting['Recipes'].items()):
+        checker = compiled['CHECKS'][k]
+        effector = compiled['EFFECTS'][k]
         relaxed_effector = make_relaxed_effector(rule)
         recipe = Recipe(name, checker, effector, relaxed_effector, rule['Time'])
         all_recipes.append(recipe)
 
-        b_checker = make_backwards_checker(rule)
-        b_effector = make_backwards_effector(rule)
+        b_checker = compiled['BACKWARDS_CHECKS'][k]
+        b_effector = compiled['BACKWARDS_EFFECTS'][k]
         b_recipe = Recipe(name, b_checker, b_effector, relaxed_effector, rule['Time'])
         all_backwards_recipes.append(b_recipe)
 
-        name_to_produces[name] = list(rule["Produces"].keys())[0]
+        effectors.append(EffectorWrapper(effector, name, rule['Time']))
+        backwards_effectors.append(EffectorWrapper(b_effector, name, rule['Time']))
+        relaxed_effectors.append(EffectorWrapper(relaxed_effector, name, rule['Time']))
+
+        name_to_produces[name] = next(iter(rule.get("Produces", {})), None)
 
         newCookBookEntry = create_cookbook_entry(name, recipe, rule)
         COOK_BOOK.append(newCookBookEntry)
@@ -870,6 +2762,224 @@ if __name__ == '__main__':
 
     updateRequired(COOK_BOOK)
 
+    # Compiled once, in the same order as all_recipes, for graph() to expand states with.
+    recipe_book = book if book is not None else RecipeBook(Crafting['Items'], Crafting['Recipes'])
+    loaded_fingerprint = fingerprint
+
+# Items of a crafting json that only lists recipes: everything any recipe mentions.
+def recipe_items(recipes):
+    items = set()
+    for rule in recipes.values():
+        for part in ("Produces", "Consumes", "Requires"):
+            items.update(rule.get(part, {}))
+    return sorted(items)
+
+# Plans many (initial, goal) queries against one recipe set.
+# recipes is a crafting json, or just its 'Recipes' dict, and queries an iterable of
+# (initial inventory, goal) dicts. The recipe set is compiled once for all of them, and
+# the queries share the named heuristics' tables (kept on the recipe book), the macro
+# cache in the cook book (with use_macros), the plan store if one is given, and the plans
+# of identical earlier queries in the same batch.
+# Results are yielded as each query finishes, as (query index, path or None).
+# With workers, the queries are planned in that many processes at once instead (see
+# plan_many_parallel); the plan store is not used then.
+# With successor_cache, the recipe book also keeps the successors of that many recently
+# expanded states for the later queries (see RecipeBook.cache_successors()). The setting
+# stays until the next plan_many(), so by default the cache is off again.
+def plan_many(recipes, queries, limit = 30, heuristic = heuristic, store = None, use_macros = False, workers = None,
+              successor_cache = 0):
+    if 'Recipes' not in recipes:
+        recipes = {'Items': recipe_items(recipes), 'Recipes': recipes}
+    elif 'Items' not in recipes:
+        recipes = {'Items': recipe_items(recipes['Recipes']), 'Recipes': recipes['Recipes']}
+    load_recipes(recipes)
+    recipe_book.cache_successors(successor_cache)
+    # A store kept for another recipe set has nothing to give and must not be written to.
+    if store is not None and store.fingerprint != loaded_fingerprint:
+        log.warning("The plan store is for other recipes, not using it.")
+        store = None
+
+    if workers is not None:
+        yield from plan_many_parallel(recipes, queries, limit, heuristic, workers, use_macros)
+        return
+
+    # (initial, goal) keys -> recipe names, or None for a query that failed
+    planned = {}
+    for index, (initial, goal) in enumerate(queries):
+        state = State(initial)
+        key = (inventory_key(state), inventory_key(goal))
+
+        if key not in planned and store is not None:
+            path = stored_path(store, state, goal)
+            if path is not None:
+                planned[key] = path_recipe_names(path)
+
+        if key not in planned:
+            if use_macros:
+                path = search_with_macros(COOK_BOOK, state, goal, limit)
+            else:
+                path = search(graph, state, make_goal_checker(goal), limit, heuristic, goal)
+            if path is None:
+                planned[key] = None
+            else:
+                planned[key] = path_recipe_names(path)
+                if store is not None:
+                    store.put(state, goal, planned[key], path_cost(path))
+
+        names = planned[key]
+        yield index, (replay_path(state, names) if names is not None else None)
+
+
+# What runs in a worker process of the pool: the initializer loads the recipe globals
+# once per worker, from the crafting json and the recipe book compiled by the parent,
+# and every task then only ships plain dicts in and a list of recipe names back.
+def init_worker(recipes, book):
+    load_recipes(recipes, book)
+
+def plan_query(initial, goal, limit, heuristic, use_macros):
+    state = State(initial)
+    if use_macros:
+        path = search_with_macros(COOK_BOOK, state, goal, limit)
+    else:
+        path = search(graph, state, make_goal_checker(goal), limit, heuristic, goal)
+    return path_recipe_names(path) if path is not None else None
+
+# plan_many() over a pool of worker processes. The recipe set is compiled once here and
+# handed to each worker when it starts; queries go out as plain dicts and plans come back
+# as recipe names, which are replayed here. Identical queries are only planned once.
+# Results are yielded as the workers finish them, so not in query order.
+def plan_many_parallel(recipes, queries, limit, heuristic, workers, use_macros):
+    queries = list(queries)
+    keys = [(inventory_key(initial), inventory_key(goal)) for initial, goal in queries]
+    waiting = defaultdict(list)
+    for index, key in enumerate(keys):
+        waiting[key].append(index)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(recipes, recipe_book)) as executor:
+        futures = {}
+        for key, indices in waiting.items():
+            initial, goal = queries[indices[0]]
+            futures[executor.submit(plan_query, initial, goal, limit, heuristic, use_macros)] = key
+        for future in as_completed(futures):
+            names = future.result()
+            for index in waiting[futures[future]]:
+                state = State(queries[index][0])
+                yield index, (replay_path(state, names) if names is not None else None)
+
+# Items that are only ever required, never consumed: one of them is all anyone needs.
+def catalyst_items(book):
+    required = set()
+    consumed = set()
+    for r in range(len(book)):
+        required.update(i for i, amount in enumerate(book.require[r]) if amount)
+        consumed.update(i for i, amount in enumerate(book.consume[r]) if amount)
+    return required - consumed
+
+# True when the named recipes run one after the other from counts and end at goal.
+def reaches_goal(book, counts, names, goal):
+    counts = list(counts)
+    for name in names:
+        r = book.ids[name]
+        for i, amount in book.need[r]:
+            if counts[i] < amount:
+                return False
+        for i, change in book.changes[r]:
+            counts[i] += change
+    return all(counts[book.index[item]] >= amount for item, amount in goal.items())
+
+# names without every step the rest of the plan can do without, tried first step first:
+# a step is dropped when what earlier steps left over already covers what it makes.
+def drop_redundant_steps(book, state, names, goal):
+    names = list(names)
+    i = 0
+    while i < len(names):
+        shorter = names[:i] + names[i + 1:]
+        if reaches_goal(book, state.counts, shorter, goal):
+            names = shorter
+        else:
+            i += 1
+    return names
+
+# Plans a goal with several items by planning each item on its own, concurrently, and
+# merging the plans. The merge runs the plans one after the other from the initial
+# inventory, skipping steps that would make a catalyst (a bench, a pickaxe, ...) that is
+# already held and not wanted by the goal, and then drops the steps whose products the
+# other plans' leftovers already cover. If a step can not run, or the merged plan falls
+# short of the goal, the rest is planned by search() from wherever the merge got to.
+# Each item's plan is optimal for that item only, so the merged plan can still cost more
+# than planning the whole goal at once, for instance when two plans each round their own
+# runs of a recipe that makes several at a time (4 planks a wood) up.
+def plan_subgoals_parallel(recipes, initial, goal, limit = 30, heuristic = heuristic, workers = None):
+    if 'Items' not in recipes:
+        recipes = {'Items': recipe_items(recipes.get('Recipes', recipes)), 'Recipes': recipes.get('Recipes', recipes)}
+    load_recipes(recipes)
+    start_time = time()
+
+    subgoals = [{item: amount} for item, amount in goal.items()]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(recipes, recipe_book)) as executor:
+        subplans = list(executor.map(plan_query, [initial] * len(subgoals), subgoals,
+                                     [limit] * len(subgoals), [heuristic] * len(subgoals),
+                                     [False] * len(subgoals)))
+
+    catalysts = catalyst_items(recipe_book)
+    state = State(initial)
+    current_state = state
+    steps = []
+    for names in subplans:
+        if names is None:
+            break
+        for name in names:
+            r = recipe_book.ids[name]
+            made = [i for i, amount in recipe_book.gains[r]]
+            if all(i in catalysts and current_state.counts[i] >= 1 and
+                   recipe_book.items[i] not in goal for i in made):
+                continue
+            if r not in recipe_book.applicable(current_state.counts):
+                break
+            current_state = all_recipes[r].effect(current_state)
+            steps.append(name)
+        else:
+            continue
+        break
+
+    goal_reached = make_goal_checker(goal)
+    if goal_reached(current_state):
+        return replay_path(state, drop_redundant_steps(recipe_book, state, steps, goal))
+    path = replay_path(state, steps)
+    rest = search(graph, current_state, goal_reached, limit - (time() - start_time), heuristic, goal)
+    if rest is None:
+        return None
+    return rest[:-1] + path
+
+#^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^#
+################# END OF LIBRARY RELATED FUNCTIONS ##########################
+#############################################################################
+
+
+# The json file designates the initial state, and the goals.
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    recipe_path = 'crafting.json'
+    with open(recipe_path) as f:
+        Crafting = json.load(f)
+
+    # # List of items that can be in your inventory:
+    #print('All items:', Crafting['Items'])
+    #
+    # # List of items in your initial inventory with amounts:
+    #print('Initial inventory:', Crafting['Initial'])
+    #
+    # # List of items needed to be in your inventory at the end of the plan:
+    #print('Goal:',Crafting['Goal'])
+    #
+    # # Dict of crafting recipes (each is a dict):
+    #print('Example recipe:','craft stone_pickaxe at bench ->',Crafting['Recipes']['craft stone_pickaxe at bench'])
+
+    # Builds all_recipes, recipe_book, COOK_BOOK and the rest of the recipe globals.
+    load_recipes(Crafting)
 
     #print("The for loop ran {} times".format(count))
 
@@ -877,8 +2987,7 @@ if __name__ == '__main__':
     is_goal = make_goal_checker(Crafting['Goal'])
 
     # Initialize first state from initial inventory
-    state = State({key: 0 for key in Crafting['Items']})
-    state.update(Crafting['Initial'])
+    state = State(Crafting['Initial'])
 
     print("This is the current goal: {}".format(Crafting['Goal']))
     #learn_shortest_paths(COOK_BOOK, Crafting['Goal'])
@@ -890,8 +2999,10 @@ if __name__ == '__main__':
             print(step)
         print()
     """
-    # Search for a solution
-    resulting_plan = search(graph, state, is_goal, 300, heuristic, Crafting['Goal'])
+    # Search for a solution, or take it from the plans of earlier runs.
+    plan_store = PlanStore(plan_store_path(recipe_path), Crafting)
+    resulting_plan = search_with_store(plan_store, graph, state, is_goal, 300, heuristic, Crafting['Goal'])
+    plan_store.close()
     #resulting_plan = bi_search(graph, state, is_goal, 3000, heuristic, Crafting['Goal'])
     #resulting_plan = None
     if resulting_plan:
@@ -2,6 +2,7 @@ import json
 from collections import namedtuple, defaultdict, OrderedDict
 from timeit import default_timer as time
 from _heapq import heappop, heappush, heapify
+from math import inf
 
 Recipe = namedtuple('Recipe', ['name', 'check', 'effect', 'cost'])
 
@@ -14,29 +15,135 @@ class Node():
     def __lt__(self, other):
         return self.cost < other.cost
 
-class State(OrderedDict):
-    """ This class is a thin wrapper around an OrderedDict, which is simply a dictionary which keeps the order in
-        which elements are added (for consistent key-value pair comparisons). Here, we have provided functionality
-        for hashing, should you need to use a state as a key in another dictionary, e.g. distance[state] = 5. By
-        default, dictionaries are not hashable. Additionally, when the state is converted to a string, it removes
-        all items with quantity 0.
+# The A* open list. A binary heap indexed by state, so membership tests are a dictionary
+# lookup and a state can be pushed again with a lower priority (decrease-key). The older,
+# worse heap entry is not searched for and removed; it stays in the heap and pop() skips
+# it because it no longer matches the entry recorded for its state (lazy deletion).
+class OpenList():
+    def __init__(self):
+        self.heap = []
+        # state -> (priority, tie breaker) of its one live entry in the heap
+        self.entries = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, state):
+        return state in self.entries
+
+    # Adds the state, or lowers its priority. Returns False when the state was already
+    # queued with a priority at least as good.
+    def push(self, state, priority, item=None):
+        entry = self.entries.get(state)
+        if entry is not None and entry[0] <= priority:
+            return False
+        self.counter += 1
+        self.entries[state] = (priority, self.counter)
+        heappush(self.heap, (priority, self.counter, state, item))
+        return True
 
-        Use of this state representation is optional, should you prefer another.
+    # Removes and returns (priority, state, item) with the lowest priority.
+    def pop(self):
+        while self.heap:
+            priority, count, state, item = heappop(self.heap)
+            entry = self.entries.get(state)
+            if entry is not None and entry[1] == count:
+                del self.entries[state]
+                return priority, state, item
+        raise IndexError("pop from an empty OpenList")
+
+    # The lowest live priority without removing it, or inf when empty.
+    def peek(self):
+        while self.heap:
+            priority, count, state, item = self.heap[0]
+            entry = self.entries.get(state)
+            if entry is not None and entry[1] == count:
+                return priority
+            heappop(self.heap)
+        return inf
+
+    def discard(self, state):
+        self.entries.pop(state, None)
+
+class State():
+    """ This class is a compact, immutable inventory. All states share one fixed item layout, which is set once from
+        Crafting['Items'] with State.set_layout(), and each state only holds a tuple of counts in that order. The hash
+        is computed once when the state is built, so using a state as a key in another dictionary, e.g.
+        distance[state] = 5, or putting it in a set costs no more than an integer comparison. Reading still works like
+        the old dictionary version (state['plank'], state.items(), ...). Additionally, when the state is converted to
+        a string, it removes all items with quantity 0.
+
+        States are never changed in place. Effectors build the next state from a list of counts with
+        State.from_counts().
     """
 
-    def __key(self):
-        return tuple(self.items())
+    __slots__ = ('counts', '_hash')
+
+    # The shared item layout: item names in order, and item name -> position in counts.
+    ITEMS = ()
+    INDEX = {}
+
+    @classmethod
+    def set_layout(cls, items):
+        cls.ITEMS = tuple(items)
+        cls.INDEX = {item: i for i, item in enumerate(cls.ITEMS)}
+
+    @classmethod
+    def from_counts(cls, counts):
+        new_state = cls.__new__(cls)
+        new_state.counts = tuple(counts)
+        new_state._hash = hash(new_state.counts)
+        return new_state
+
+    def __init__(self, inventory=None):
+        counts = [0] * len(self.ITEMS)
+        if inventory:
+            for item, amount in inventory.items():
+                counts[self.INDEX[item]] = amount
+        self.counts = tuple(counts)
+        self._hash = hash(self.counts)
+
+    def __getitem__(self, item):
+        return self.counts[self.INDEX[item]]
+
+    def get(self, item, default=0):
+        if item in self.INDEX:
+            return self.counts[self.INDEX[item]]
+        return default
+
+    def __contains__(self, item):
+        return item in self.INDEX
+
+    def __iter__(self):
+        return iter(self.ITEMS)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def keys(self):
+        return self.ITEMS
+
+    def values(self):
+        return self.counts
+
+    def items(self):
+        return zip(self.ITEMS, self.counts)
 
     def __hash__(self):
-        return hash(self.__key())
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, State):
+            return NotImplemented
+        return self._hash == other._hash and self.counts == other.counts
 
     def __lt__(self, other):
-        return self.__key() < other.__key()
+        return self.counts < other.counts
 
     def copy(self):
-        new_state = State()
-        new_state.update(self)
-        return new_state
+        # Immutable, so sharing is safe.
+        return self
 
     def __str__(self):
         return str(dict(item for item in self.items() if item[1] > 0))
@@ -90,31 +197,24 @@ def make_effector(rule):
 
     #The effector’s function is
     #to return the state resulting from applying the rule to a given state.
-    def effect(state):
-        # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
-
-
-        #Copy the state.
-        next_state = state.copy()
-        consumes_list = None
-        produces_list = None
-        if "Consumes" in rule:
-            consumes_list = rule["Consumes"].items()
-        if "Produces" in rule:
-            produces_list = rule["Produces"].items()
-
-        #Update the sate by consuming the amount of items
-        if consumes_list:
-            for consumed, amount in consumes_list:
-                next_state[consumed] -= amount
 
-        #add the amount of items produced to state.
-        if produces_list:
-            for produced, amount in produces_list:
-                next_state[produced] += amount
+    # Turn the rule into (position in the state, change in amount) pairs once, here,
+    # so the effector itself only has to add numbers to a list.
+    changes = defaultdict(int)
+    if "Consumes" in rule:
+        for consumed, amount in rule["Consumes"].items():
+            changes[State.INDEX[consumed]] -= amount
+    if "Produces" in rule:
+        for produced, amount in rule["Produces"].items():
+            changes[State.INDEX[produced]] += amount
+    changes = list(changes.items())
 
-        return next_state
+    def effect(state):
+        # This code is called by graph(state) and runs millions of times
+        next_counts = list(state.counts)
+        for index, amount in changes:
+            next_counts[index] += amount
+        return State.from_counts(next_counts)
 
     return effect
 
@@ -154,58 +254,50 @@ def heuristic(state): #take goal here.
 def search(graph, state, is_goal, limit, heuristic):
 
         start_time = time()
-        queue = []
-        closed_set = []
 
         current_state = state
         current_node = Node("Initial inventory.", current_state, 0)
         init_node = current_node
 
+        # Best known cost of reaching each state, keyed by state so duplicates are recognised.
         distances = {}
-        distances[current_node] = 0
+        distances[current_state] = 0
 
         # The dictionary that will store the backpointers
         backpointers = {}
         backpointers[current_node] = None
 
-        for state_node in graph(current_state):
-            heappush(queue, (state_node.cost, state_node))
-            #print("Printing rule in search: {}".format(recipe))
+        # Expanded states, and the open list ordered by cost + heuristic.
+        closed_set = set()
+        queue = OpenList()
+        queue.push(current_state, heuristic(current_state), current_node)
 
         # Implement your search here! Use your heuristic here!
         # When you find a path to the goal return a list of tuples [(state, action)]
         # representing the path. Each element (tuple) of the list represents a state
         # in the path and the action that took you to this state
-        #print("Printing the state: {}".format(state))
-        #print("Printing the graph: {}".format(graph))
         while time() - start_time < limit and queue:
 
+            cost_, current_state, current_node = queue.pop()
+
             if is_goal(current_state):
                 path = reconstruct_path(init_node, backpointers, current_node)
                 return path
 
-            cost_, current_node = heappop(queue)
-            current_state = current_node.state
-            closed_set.append(current_node)
+            closed_set.add(current_state)
 
             for child_node in graph(current_state):
+                child_state = child_node.state
 
                 #Lets be safe.
-                if child_node in closed_set:
+                if child_state in closed_set:
                     continue
 
-                if child_node not in queue:
-                    heappush(queue, (child_node.cost, child_node))
-
-                tentative_score = current_node.cost + child_node.cost + heuristic(current_state)
-                if child_node not in distances or tentative_score <= distances[child_node]:
-                    distances[child_node] = tentative_score
-                    heappush(queue, (tentative_score, child_node))
-                    heapify(queue)
-
-                backpointers[child_node] = current_node
-
-            print("Printing current_state in search:{}".format(current_state))
+                tentative_cost = distances[current_state] + child_node.cost
+                if tentative_cost < distances.get(child_state, inf):
+                    distances[child_state] = tentative_cost
+                    backpointers[child_node] = current_node
+                    queue.push(child_state, tentative_cost + heuristic(child_state), child_node)
 
         # Failed to find a path
         #print(time() - start_time, 'seconds.')
@@ -214,10 +306,9 @@ def search(graph, state, is_goal, limit, heuristic):
 
 def reconstruct_path(init_node, cameFrom, current_node):
     total_path = [(current_node.state, current_node.name)]
-    while current_node in cameFrom.keys():
+    while cameFrom.get(current_node) is not None:
         current_node = cameFrom[current_node]
         total_path.append((current_node.state, current_node.name))
-    total_path.append((init_node.state,init_node.name))
     return total_path
 
 
@@ -239,6 +330,9 @@ if __name__ == '__main__':
     # # Dict of crafting recipes (each is a dict):
     #print('Example recipe:','craft stone_pickaxe at bench ->',Crafting['Recipes']['craft stone_pickaxe at bench'])
 
+    # Every state shares the item layout, so it has to be fixed before the effectors are built.
+    State.set_layout(Crafting['Items'])
+
     # Build rules
     all_recipes = []
     #count = 0
@@ -255,8 +349,7 @@ if __name__ == '__main__':
     is_goal = make_goal_checker(Crafting['Goal'])
 
     # Initialize first state from initial inventory
-    state = State({key: 0 for key in Crafting['Items']})
-    state.update(Crafting['Initial'])
+    state = State(Crafting['Initial'])
 
     # Search for a solution
     print("Search has started with the goal {}".format(Crafting['Goal']))
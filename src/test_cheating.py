@@ -0,0 +1,323 @@
+import json
+import os
+import random
+from functools import lru_cache
+
+import pytest
+
+import benchmark
+import cheating
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Small generated domains, as (depth, branching, quantity, seed) for make_domain(), that
+# plain A* solves well within the limit.
+DOMAINS = ([(depth, 2, quantity, seed) for depth in (2, 3, 4) for quantity in (1, 2) for seed in range(3)] +
+           [(2, 3, quantity, seed) for quantity in (1, 2) for seed in (1, 2)] + [(3, 3, 1, 1), (3, 2, 3, 1)])
+LIMIT = 20
+
+
+def load_crafting():
+    with open(os.path.join(HERE, 'crafting.json')) as f:
+        return json.load(f)
+
+# The tests plan with fresh recipe globals and leave no generated code behind.
+@pytest.fixture(autouse=True)
+def no_code_cache(monkeypatch):
+    monkeypatch.setattr(cheating, 'RECIPE_CODE_DIR', None)
+    cheating.loaded_fingerprint = None
+    yield
+    cheating.loaded_fingerprint = None
+
+def plan_cost(path):
+    return cheating.path_cost(path) if path is not None else None
+
+# Cost of plain A* with h_max, which is optimal, for a generated domain.
+@lru_cache(maxsize=None)
+def optimal_cost(domain):
+    Crafting = benchmark.make_domain(*domain)
+    cheating.load_recipes(Crafting)
+    goal = Crafting['Goal']
+    state = cheating.State(Crafting['Initial'])
+    return plan_cost(cheating.search(cheating.graph, state, cheating.make_goal_checker(goal), LIMIT, 'h_max', goal))
+
+# A valid path: every step could run on the state before it.
+def assert_valid(path, Crafting):
+    state = cheating.State(Crafting['Initial'])
+    assert path[-1][0] == state
+    for (after, action), (before, previous) in zip(path[:-1], path[1:]):
+        recipe = cheating.all_recipes[cheating.recipe_book.ids[action.creates]]
+        assert recipe.check(before)
+        assert recipe.effect(before) == after
+
+# Loads a generated domain and returns (Crafting, state, is_goal, goal, optimal cost).
+def planning_problem(domain):
+    expected = optimal_cost(domain)
+    assert expected is not None
+    Crafting = benchmark.make_domain(*domain)
+    cheating.load_recipes(Crafting)
+    goal = Crafting['Goal']
+    return Crafting, cheating.State(Crafting['Initial']), cheating.make_goal_checker(goal), goal, expected
+
+# search() with options finds a valid plan of the optimal cost on a generated domain.
+def assert_search_optimal(domain, **options):
+    Crafting, state, is_goal, goal, expected = planning_problem(domain)
+    path = cheating.search(cheating.graph, state, is_goal, LIMIT, 'h_max', goal, **options)
+    assert plan_cost(path) == expected, options
+    assert_valid(path, Crafting)
+
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_bi_search_is_optimal(domain):
+    Crafting, state, is_goal, goal, expected = planning_problem(domain)
+    path = cheating.bi_search(cheating.graph, state, is_goal, LIMIT, cheating.heuristic, goal)
+    assert plan_cost(path) == expected
+    assert_valid(path, Crafting)
+
+def test_macros_skip_items_no_recipe_makes():
+    recipes = {'make b': {'Produces': {'b': 1}, 'Consumes': {'a': 1}, 'Time': 1}}
+    results = dict(cheating.plan_many(recipes, [({'a': 1}, {'a': 1, 'b': 1}), ({'a': 2}, {'a': 1, 'b': 1})],
+                                      use_macros = True))
+    assert results[0] is None
+    assert results[1][0][0]['b'] == 1
+
+def test_plan_store_is_only_used_for_its_recipes(tmp_path):
+    Crafting = load_crafting()
+    store = cheating.PlanStore(str(tmp_path / 'crafting.plans.sqlite'), Crafting)
+    try:
+        [(index, path)] = cheating.plan_many(Crafting, [({}, {'plank': 4})], store = store)
+        assert cheating.path_cost(path) == 5
+
+        changed = json.loads(json.dumps(Crafting))
+        changed['Recipes']['craft plank']['Produces'] = {'plank': 1}
+        [(index, path)] = cheating.plan_many(changed, [({}, {'plank': 4})], store = store)
+        assert path[0][0]['plank'] == 4
+
+        # A stored plan that falls short of its goal is a miss.
+        cheating.load_recipes(Crafting)
+        store.put(cheating.State({}), {'plank': 8}, ['punch for wood', 'craft plank'], 5)
+        [(index, path)] = cheating.plan_many(Crafting, [({}, {'plank': 8})], store = store)
+        assert path[0][0]['plank'] >= 8
+    finally:
+        store.close()
+
+# A tool that only the initial inventory holds, and a recipe that makes nothing.
+def test_plan_many_takes_recipes_the_cook_book_has_no_entry_for():
+    recipes = {'make b': {'Produces': {'b': 1}, 'Requires': {'tool': True}, 'Time': 1},
+               'drop b': {'Consumes': {'b': 1}, 'Time': 1}}
+    for use_macros in (False, True):
+        [(index, path)] = cheating.plan_many(recipes, [({'tool': 1}, {'b': 1})], use_macros = use_macros)
+        assert path[0][0]['b'] == 1
+        assert path[0][0]['tool'] == 1
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_dominance_keeps_optimal_cost(domain):
+    assert_search_optimal(domain, dominance = True)
+
+def test_dominance_index_matches_brute_force():
+    rng = random.Random(1)
+    for by_support in (True, False):
+        index = cheating.DominanceIndex(by_support = by_support)
+        stored = {}
+        for step in range(3000):
+            counts = tuple(rng.choice((0, 0, 1, 2, 3)) for i in range(6))
+            if rng.random() < 0.2 and stored:
+                gone = rng.choice(list(stored))
+                index.discard(gone)
+                del stored[gone]
+            else:
+                index.add(counts, step)
+                stored[counts] = step
+            assert len(index) == len(stored)
+            if step % 10 == 0:
+                query = tuple(rng.choice((0, 0, 1, 2, 3)) for i in range(6))
+                assert sorted(index.covering(query)) == sorted(
+                    value for entry, value in stored.items() if all(a >= b for a, b in zip(entry, query)))
+                assert sorted(index.covered_by(query)) == sorted(
+                    value for entry, value in stored.items() if all(a <= b for a, b in zip(entry, query)))
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_caps_keep_optimal_cost(domain):
+    assert_search_optimal(domain, caps = True)
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_reduction_keeps_optimal_cost(domain):
+    assert_search_optimal(domain, reduction = True)
+    assert_search_optimal(domain, caps = True, reduction = True)
+
+@pytest.mark.parametrize('goal, expected', [({'furnace': 1}, 48), ({'iron_pickaxe': 1}, 83), ({'cart': 1}, 104)])
+def test_crafting_json_costs(goal, expected):
+    cheating.load_recipes(load_crafting())
+    path = cheating.search(cheating.graph, cheating.State({}), cheating.make_goal_checker(goal), LIMIT, 'h_max', goal,
+                           caps = True, reduction = True)
+    assert plan_cost(path) == expected
+
+def test_plan_many_turns_the_successor_cache_off_again():
+    Crafting = load_crafting()
+    list(cheating.plan_many(Crafting, [({}, {'plank': 4})], successor_cache = 100))
+    assert cheating.recipe_book.cache is not None
+    list(cheating.plan_many(Crafting, [({}, {'plank': 4})]))
+    assert cheating.recipe_book.cache is None
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_memory_bounded_search_keeps_optimal_cost(domain):
+    assert_search_optimal(domain, caps = True, reduction = True, algorithm = 'ida')
+    assert_search_optimal(domain, caps = True, reduction = True, algorithm = 'sma')
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_regression_search_is_optimal(domain):
+    Crafting, state, is_goal, goal, expected = planning_problem(domain)
+    path = cheating.regression_search(state, goal, LIMIT, 'h_max')
+    assert plan_cost(path) == expected
+    assert_valid(path, Crafting)
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_bill_of_materials_keeps_optimal_cost(domain):
+    assert_search_optimal(domain, caps = True, reduction = True, algorithm = 'bom')
+    Crafting, state, is_goal, goal, expected = planning_problem(domain)
+    path = cheating.bom_search(cheating.graph, state, is_goal, LIMIT, 'h_max', goal)
+    assert plan_cost(path) == expected
+    assert_valid(path, Crafting)
+
+# Goals that are trees of single producers, but where counting runs item by item
+# overshoots: a recipe making two of the goal items, and a tool that is used up later.
+BOM_TRAPS = [
+    {'Items': ['a', 'b', 'c'], 'Initial': {}, 'Goal': {'a': 3, 'b': 2},
+     'Recipes': {'make a and b': {'Consumes': {'c': 1}, 'Produces': {'a': 3, 'b': 2}, 'Time': 3},
+                 'make c': {'Produces': {'c': 1}, 'Time': 1}}},
+    {'Items': ['tool', 'x', 'y'], 'Initial': {}, 'Goal': {'x': 1, 'y': 1},
+     'Recipes': {'make tool': {'Produces': {'tool': 1}, 'Time': 5},
+                 'use tool': {'Requires': {'tool': True}, 'Produces': {'x': 1}, 'Time': 1},
+                 'melt tool': {'Consumes': {'tool': 1}, 'Produces': {'y': 1}, 'Time': 1}}},
+    {'Items': ['tool', 'x', 'y'], 'Initial': {'tool': 1}, 'Goal': {'x': 1, 'y': 1},
+     'Recipes': {'make tool': {'Produces': {'tool': 1}, 'Time': 5},
+                 'use tool': {'Requires': {'tool': True}, 'Produces': {'x': 1}, 'Time': 1},
+                 'melt tool': {'Consumes': {'tool': 1}, 'Produces': {'y': 1}, 'Time': 1}}},
+]
+
+@pytest.mark.parametrize('Crafting', BOM_TRAPS)
+def test_bill_of_materials_leaves_shared_items_to_search(Crafting):
+    cheating.load_recipes(Crafting)
+    goal = Crafting['Goal']
+    state = cheating.State(Crafting['Initial'])
+    is_goal = cheating.make_goal_checker(goal)
+    assert cheating.bill_of_materials(cheating.recipe_book, state, goal) is None
+    expected = plan_cost(cheating.search(cheating.graph, state, is_goal, LIMIT, 'h_max', goal))
+    for alternatives in (False, True):
+        path = cheating.bom_search(cheating.graph, state, is_goal, LIMIT, 'h_max', goal, alternatives = alternatives)
+        assert plan_cost(path) == expected
+        assert_valid(path, Crafting)
+
+@pytest.mark.parametrize('goal, expected', [({'furnace': 1}, 48), ({'iron_pickaxe': 1}, 83), ({'cart': 1}, 104)])
+def test_crafting_json_bill_of_materials_costs(goal, expected):
+    cheating.load_recipes(load_crafting())
+    path = cheating.search(cheating.graph, cheating.State({}), cheating.make_goal_checker(goal), LIMIT, 'h_max', goal,
+                           caps = True, reduction = True, algorithm = 'bom')
+    assert plan_cost(path) == expected
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_batches_keep_optimal_cost(domain):
+    assert_search_optimal(domain, caps = True, reduction = True, batches = True)
+
+@pytest.mark.parametrize('domain', DOMAINS)
+def test_search_relevant_keeps_optimal_cost(domain):
+    Crafting, state, is_goal, goal, expected = planning_problem(domain)
+    path = cheating.search_relevant(Crafting, LIMIT, 'h_max', caps = True)
+    assert plan_cost(path) == expected
+    assert_valid(path, Crafting)
+
+def test_prune_crafting_keeps_relevant_recipes():
+    pruned = cheating.prune_crafting(load_crafting(), {'furnace': 1})
+    assert 'craft cart at bench' not in pruned['Recipes']
+    assert 'craft rail at bench' not in pruned['Recipes']
+    assert 'craft furnace at bench' in pruned['Recipes']
+    assert 'cart' not in pruned['Items']
+
+def test_search_relevant_restores_recipes_when_search_raises():
+    Crafting = load_crafting()
+    with pytest.raises(ValueError):
+        cheating.search_relevant(Crafting, LIMIT, 'no such heuristic', goal = {'furnace': 1})
+    assert len(cheating.all_recipes) == len(Crafting['Recipes'])
+    assert cheating.State.ITEMS == tuple(Crafting['Items'])
+
+# The recipe sets the compilation tests run on.
+def recipe_sets():
+    yield load_crafting()
+    with open(os.path.join(HERE, 'craftingSimplified.json')) as f:
+        yield json.load(f)
+    for seed in range(15):
+        yield benchmark.make_domain(2 + seed % 5, 2 + seed % 3, 3, seed)
+
+def test_successors_match_applicable():
+    for Crafting in recipe_sets():
+        cheating.load_recipes(Crafting)
+        book = cheating.recipe_book
+        frontier = [cheating.State({})]
+        seen = set(frontier)
+        for expansion in range(2000):
+            if not frontier:
+                break
+            state = frontier.pop()
+            counts = state.counts
+            successors = book.successors(state)
+            assert [r for r, next_state in successors] == book.applicable(counts)
+            for r, next_state in successors:
+                assert list(next_state.counts) == [count + change for count, change in zip(counts, book.delta[r])]
+                if next_state not in seen:
+                    seen.add(next_state)
+                    frontier.append(next_state)
+
+# The generated checkers and effectors against the recipe json itself.
+def test_generated_recipes_follow_the_rules():
+    rng = random.Random(0)
+    for Crafting in recipe_sets():
+        cheating.load_recipes(Crafting)
+        index = cheating.State.INDEX
+        for k, (name, rule) in enumerate(Crafting['Recipes'].items()):
+            recipe = cheating.all_recipes[k]
+            backwards = cheating.all_backwards_recipes[k]
+            consumes = rule.get('Consumes', {})
+            requires = rule.get('Requires', {})
+            produces = rule.get('Produces', {})
+            for attempt in range(50):
+                state = cheating.State.from_counts([rng.randint(0, 4) for item in Crafting['Items']])
+                runnable = (all(state[item] >= amount for item, amount in consumes.items()) and
+                            all(state[item] >= 1 for item in requires))
+                assert recipe.check(state) == runnable, name
+
+                counts = list(state.counts)
+                for item, amount in consumes.items():
+                    counts[index[item]] -= amount
+                for item, amount in produces.items():
+                    counts[index[item]] += amount
+                assert list(recipe.effect(state).counts) == counts, name
+
+                assert backwards.check(state) == any(state[item] > 0 for item in produces), name
+                counts = list(state.counts)
+                for item, amount in produces.items():
+                    counts[index[item]] = max(counts[index[item]] - amount, 0)
+                for item, amount in consumes.items():
+                    counts[index[item]] += amount
+                for item in requires:
+                    counts[index[item]] = max(counts[index[item]], 1)
+                assert list(backwards.effect(state).counts) == counts, name
+
+def test_recipe_code_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cheating, 'RECIPE_CODE_DIR', str(tmp_path))
+    monkeypatch.setattr(cheating, 'RECIPE_CODE_FILES', 3)
+    Crafting = load_crafting()
+    cheating.compile_recipes(Crafting)
+    assert len(os.listdir(str(tmp_path))) == 1
+    module = cheating.compile_recipes(Crafting)
+    assert len(module['CHECKS']) == len(Crafting['Recipes'])
+    for seed in range(5):
+        cheating.compile_recipes(benchmark.make_domain(2, 2, 1, seed))
+    assert len(os.listdir(str(tmp_path))) == 3
+
+def test_recipe_names_stay_in_comments(capsys):
+    name = 'x\nprint("INJECTED")\r\nraise SystemExit'
+    Crafting = {'Items': ['a'], 'Initial': {}, 'Goal': {'a': 1},
+                'Recipes': {name: {'Produces': {'a': 1}, 'Time': 1}}}
+    cheating.load_recipes(Crafting)
+    assert 'INJECTED' not in capsys.readouterr().out
+    assert cheating.all_recipes[0].effect(cheating.State({}))['a'] == 1